@@ -35,92 +35,211 @@ the exported files.
 For performance reasons, there is no validation of the number of columns
 or order of column labels - the header and lines are written as-is, so
 make sure to only split/re-merge compatible data.
+Lines of an image found in several merge files (or in separate runs of
+lines) are appended to the same file, below a single header.
 Create an import folder (or have the script create one for you) at the
 current location and place the TOTAL_Object_Results.csv into there.
 The output will be written into only into an empyt (needs to be empty)
-export folder.
+export folder, unless the export folder contains a manifest from a previous
+run: Then only new or changed merge files are split again, together with
+all merge files sharing images with them, see the "run_manifest" module
+for details. If a changed merge file adds an image of an unchanged merge
+file, all merge files are split again.
+Optionally, each image can be downsampled to a fixed number of lines,
+see the "reservoir_sampling" module for details.
+Run metrics are recorded with the "run_metrics" module, use the "--quiet"
+option to skip progress messages for large data sets.
+Merge files with a valid cache are split by copying the lines of each
+image directly from the merge file, see the "cell_table_cache" module.
+Optionally, cell counts and intensity means per image are summarized while
+splitting, see the "summary_table" module for details.
+Merge files are read ahead and split files are written in the background,
+see the "io_pipeline" module for details.
 """
 
 #  imports
 
-import fnmatch
-import io
 import os
 import re
 import sys
 
+from cell_table_cache import build_cache, open_cache
+from file_discovery import get_files
+from io_pipeline import CHUNK_LINES, WriterPool, iter_lines
+from reservoir_sampling import SAMPLING_COLUMN, Reservoir, append_column, get_sample
+from run_manifest import RunManifest, get_manifest_file
+from run_metrics import RunMetrics
+from summary_table import SummaryTable
+
 #  functions
 
 
-def get_files(path="", pat="*", anti="", recurse=False):
-    """Iterate through all files in a directory structure and
-       return a list of matching files.
+def get_image_name(line="", pattern=""):
+    """Uses a regular expression search to match a pattern against a text.
+
+    Keyword arguments:
+    line -- the line of text to find the pattern in
+    pattern -- the regular expression used in the search
+    """
+    return re.search(pattern, line).group(1)
+
+
+def get_split_files(files=None):
+    """Returns the merge files to split: New or changed merge files and, since
+    images can span merge files, all merge files sharing outputs with them.
 
     Keyword arguments:
-    path -- the path to a directory containing files (default "")
-    pat -- string pattern that needs to be part of the file name (default "None")
-    anti -- string pattern that may not be part of the file name (default "None")
-    recurse -- boolen that allows the function to work recursively (default "False")
+    files -- the list of merge files
     """
-    FILES = []
-    for root, dirs, files in os.walk(path):
+    if not MANIFEST:
+        return list(files)
+    split_files = [
+        file
+        for file in files
+        if not MANIFEST.is_current(file)
+        or (SUMMARY and MANIFEST.get_data(file) is None)  # not summarized before
+    ]
+    outputs = {output for file in split_files for output in MANIFEST.get_outputs(file)}
+    shared = True
+    while shared:  # add files sharing outputs, until no more are found
+        shared = False
         for file in files:
-            file = os.path.join(root, file)
-            if fnmatch.fnmatch(file, pat) and not fnmatch.fnmatch(file, anti):
-                FILES.append(file)
-        if not recurse:
-            break  # from `os.walk()`
-    return FILES
+            if file not in split_files and outputs.intersection(
+                MANIFEST.get_outputs(file)
+            ):
+                split_files.append(file)
+                outputs.update(MANIFEST.get_outputs(file))
+                shared = True
+    return [file for file in files if file in split_files]  # keep order
 
 
-def get_image_name(line="", pattern=""):
-    """Uses a regular expression search to match a pattern against a text.
+def unmerge_cache(cache=None, out_path="", sample_size=0, summary=None):
+    """Writes out the data of each image from the cache of a merge file, the lines
+    are copied as-is from the merge file unless images are downsampled.
 
     Keyword arguments:
-    line -- the line of text to find the pattern in
-    pattern -- the regular expression used in the search
+    cache -- the cache of the merge file
+    out_path -- the path to the export folder
+    sample_size -- the number of lines per image, downsample if positive
+    summary -- the summary table to add the lines to, if any
     """
-    return re.search(pattern, line).group(1)
+    if summary:
+        summary.set_header(cache.get_header().decode(cache.encoding))
+    images = cache.get_groups(lambda line: get_image_name(line, pattern=NAME_PATTERN))
+    with WriterPool() as writers:
+        for image_name, start, stop in images:
+            touched_images.add(image_name)
+            out_file_path = os.path.abspath(os.path.join(out_path, image_name + ".csv"))
+            out_lines = []
+            if image_name not in known_images:
+                out_lines.append(cache.get_header())
+                known_images.add(image_name)
+            if summary:
+                summary.add_rows(image_name, cache, start, stop)
+            if sample_size > 0:  # read kept lines only
+                reservoir = Reservoir(sample_size, SAMPLE_SEED, image_name)
+                for row in range(start, stop):
+                    reservoir.add(row)
+                fraction = str(reservoir.get_fraction())
+                if out_lines:  # header
+                    header = out_lines.pop().decode(cache.encoding)
+                    out_lines.append(append_column(header, SAMPLING_COLUMN, ","))
+                for row in reservoir.get_lines():
+                    out_lines.append(append_column(cache.get_line(row), fraction, ","))
+                writers.write(out_file_path, out_lines, "a", "utf-8", close=True)
+            else:  # copy lines
+                out_lines.append(cache.get_rows(start, stop))
+                writers.write(out_file_path, out_lines, "ab", close=True)
+    return (cache.rows, len(known_images))
 
 
-def unmerge_data(in_path="", out_path=""):
+def unmerge_data(in_path="", out_path="", sample_size=0, summary=None):
     """Imports data from a text file and writes out all columns on a per-file basis
-    using the first column's data for labeling of individual export files."""
-    with open(in_path, "r", encoding="utf-8-sig") as in_file:
-        print('\tFOLDER: "' + out_path + '"', flush=True)
-        if not os.path.exists(out_path):
-            os.mkdir(out_path)
-        if os.listdir(out_path):
-            print("OUTPUT PATH NOT EMPTY. EXITING.")
-            sys.exit(0)
-        out_file = io.StringIO("")
-        header = in_file.readline()  # read and call `next()` on iterator
+    using the first column's data for labeling of individual export files.
+    Images are downsampled to `sample_size` lines, if `sample_size` is positive.
+    Lines are added to the `summary`, if given."""
+    METRICS.log('\tFOLDER: "' + out_path + '"')
+    if not os.path.exists(out_path):
+        os.mkdir(out_path)
+    if os.listdir(out_path) and not (MANIFEST and MANIFEST.exists):
+        print("OUTPUT PATH NOT EMPTY. EXITING.")
+        sys.exit(0)
+    cache = open_cache(in_path)
+    if not cache and BUILD_CACHE:
+        build_cache(in_path=in_path, key_label="Image Location", encoding="utf-8")
+        cache = open_cache(in_path)
+    if cache:
+        try:
+            return unmerge_cache(
+                cache=cache, out_path=out_path, sample_size=sample_size, summary=summary
+            )
+        finally:
+            cache.close()
+    with WriterPool() as writers:
+        in_file = iter_lines(in_path, encoding="utf-8-sig")
+        out_file_path = ""
+        out_lines = []
+        reservoir = None
+        previous_image = None
+        header = next(in_file, "")  # read and call `next()` on iterator
+        if summary:
+            summary.set_header(header)
+        if sample_size > 0:
+            header = append_column(header, SAMPLING_COLUMN, ",")
         for lines, in_line in enumerate(in_file, start=1):
             image_name = get_image_name(in_line, pattern=NAME_PATTERN)
-            if image_name not in known_images:
-                out_file.close()  # previous file
+            if image_name != previous_image:  # image changed
+                if reservoir:  # previous sample
+                    out_lines.extend(get_sample(reservoir, ","))
+                if out_file_path:  # previous file
+                    writers.write(out_file_path, out_lines, "a", "utf-8", close=True)
+                touched_images.add(image_name)
                 out_file_path = os.path.abspath(
                     os.path.join(out_path, image_name + ".csv")
                 )
-                out_file = open(out_file_path, "a", encoding="utf-8")  # current file
-                out_file.write(header)
-                known_images.add(image_name)
-            out_file.write(in_line)
-        out_file.close()  # last file
+                out_lines = []  # current file
+                if image_name not in known_images:
+                    out_lines.append(header)
+                    known_images.add(image_name)
+                if sample_size > 0:
+                    reservoir = Reservoir(sample_size, SAMPLE_SEED, image_name)
+                previous_image = image_name
+            if summary:
+                summary.add(image_name, in_line)
+            if reservoir:
+                reservoir.add(in_line)
+            else:
+                out_lines.append(in_line)
+                if len(out_lines) >= CHUNK_LINES:  # write in chunks
+                    writers.write(out_file_path, out_lines, "a", "utf-8")
+                    out_lines = []
+        if reservoir:  # last sample
+            out_lines.extend(get_sample(reservoir, ","))
+        if out_file_path:  # last file
+            writers.write(out_file_path, out_lines, "a", "utf-8", close=True)
         return (lines, len(known_images))
 
 
 #  constants & variables
 
+BUILD_CACHE = False  # cache merge files before splitting, for repeated splits
 EXPORT_FOLDER = r".\export"
+FAST_HASH = False  # also fingerprint merge files by sampled content
 FILE_TARGET = "*Total_Object_Results.csv"
 IMPORT_FOLDER = r".\import"
+INCREMENTAL = True  # split only new or changed merge files
 # NAME_PATTERN = re.compile(r"(\d{6}\s[\w#&\s\-_\.+]+)(?=_Scan)")  # Akoya Polaris
 NAME_PATTERN = re.compile(r"\\([^\\]+?)\.[^\\.]+(?=" ")")  # generic
+SAMPLE_SEED = 0  # fixed seed for reproducible downsampling
+SAMPLE_SIZE = 0  # lines per image, downsample if positive
+SUMMARIZE = False  # summarize cell counts and intensity means while splitting
+SUMMARY_FILE = "summary_table.csv"
+SUMMARY_PATTERN = r"Intensity"  # labels of the summarized columns
 VERSION = "HALO_summaryfile_splitter 1.0 (2024-09-25)"
 
 #  main program
 
+METRICS = RunMetrics(VERSION)
 print(VERSION)
 print(os.linesep)
 print("UNMERGING files in folder:")
@@ -133,14 +252,94 @@ if not os.path.exists(EXPORT_FOLDER):
 if not os.path.exists(IMPORT_FOLDER):
     os.mkdir(IMPORT_FOLDER)
 
-known_images = set()  # keep across multiple merge files
-for index, file in enumerate(get_files(IMPORT_FOLDER, FILE_TARGET)):
-    print("\tFILE: " + file)
-    unmerged = unmerge_data(in_path=file, out_path=EXPORT_FOLDER)
-    print("\tLINES: " + str(unmerged[0]), "MATCHES: " + str(unmerged[1]))
-    FILE_COUNT += 1
+MANIFEST = None
+if INCREMENTAL:
+    MANIFEST = RunManifest(
+        os.path.join(EXPORT_FOLDER, get_manifest_file(VERSION)),
+        FAST_HASH,
+        settings={
+            "NAME_PATTERN": NAME_PATTERN.pattern,
+            "SAMPLE_SEED": SAMPLE_SEED,
+            "SAMPLE_SIZE": SAMPLE_SIZE,
+            "SUMMARY_PATTERN": SUMMARY_PATTERN,
+            "VERSION": VERSION,
+        },
+    )
+FILES = get_files(IMPORT_FOLDER, include=[FILE_TARGET])
+if MANIFEST and MANIFEST.exists:
+    print("STALE OUTPUTS: " + str(MANIFEST.prune(FILES)))
+    MANIFEST.save()
+
+SUMMARY = None
+if SUMMARIZE:
+    SUMMARY = SummaryTable(SUMMARY_PATTERN, delimiter=",")
+
+METRICS.start_phase("unmerge")
+SPLIT_FILES = get_split_files(FILES)
+while True:  # split all files, if images of unchanged files were touched
+    SKIPPED_IMAGES = set()  # images of unchanged files
+    for file in FILES:
+        if file not in SPLIT_FILES:
+            SKIPPED_IMAGES.update(
+                os.path.splitext(os.path.basename(output))[0]
+                for output in MANIFEST.get_outputs(file)
+            )
+    if MANIFEST:  # remove all outputs before writing any
+        for file in SPLIT_FILES:
+            MANIFEST.remove_outputs(file)
+    if SUMMARIZE:
+        SUMMARY = SummaryTable(SUMMARY_PATTERN, delimiter=",")
+    known_images = set(SKIPPED_IMAGES)  # keep across multiple merge files
+    touched_images = set()  # images of the current merge file
+    written_images = set()
+    FILE_COUNT = 0
+    for index, file in enumerate(FILES):
+        METRICS.log("\tFILE: " + file)
+        if file not in SPLIT_FILES:
+            if SUMMARY:
+                SUMMARY.merge(MANIFEST.get_data(file))
+            METRICS.log("\tUNCHANGED")
+            continue
+        touched_images.clear()
+        summary = None
+        if SUMMARY:
+            summary = SummaryTable(SUMMARY_PATTERN, delimiter=",")
+        unmerged = unmerge_data(
+            in_path=file,
+            out_path=EXPORT_FOLDER,
+            sample_size=SAMPLE_SIZE,
+            summary=summary,
+        )
+        METRICS.log("\tLINES: " + str(unmerged[0]) + " MATCHES: " + str(unmerged[1]))
+        METRICS.count_read(file, rows=unmerged[0])
+        written_images.update(touched_images)
+        if summary:
+            SUMMARY.merge(summary.get_data())
+        if MANIFEST:
+            MANIFEST.record(
+                file,
+                outputs=[
+                    os.path.join(EXPORT_FOLDER, image_name + ".csv")
+                    for image_name in touched_images
+                ],
+                data=summary.get_data() if summary else None,
+            )
+            MANIFEST.save()
+        FILE_COUNT += 1
+        if touched_images & SKIPPED_IMAGES:  # images span changed and unchanged files
+            break
+    else:  # all files split
+        break
+    METRICS.log("\tIMAGES SHARED WITH UNCHANGED FILES, SPLITTING ALL FILES")
+    SPLIT_FILES = list(FILES)
+for image_name in written_images:
+    METRICS.count_written(os.path.join(EXPORT_FOLDER, image_name + ".csv"))
+if SUMMARY:
+    SUMMARY.write(os.path.join(EXPORT_FOLDER, SUMMARY_FILE), group_label="Image")
+    METRICS.count_written(os.path.join(EXPORT_FOLDER, SUMMARY_FILE))
 
 print("FILES: " + str(FILE_COUNT))
+METRICS.finish()
 print(os.linesep)
 
 
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      run_benchmarks
+Summary:    Measure the throughput and memory usage of the scripts
+            with synthetic input data of increasing size
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+Each benchmark generates synthetic input data with the "synthetic_data"
+module in a scratch folder, runs the unmodified script in a separate
+process with the scratch folder as its working directory, and reports
+the wall time, rows per second, megabytes per second, and peak resident
+memory (RSS) of the script's process. The scratch folder is removed after
+each measurement, so that only one data set occupies the disk at a time.
+Sizes are given with units, e.g. "python run_benchmarks.py --sizes 10MB 1GB
+20GB --scratch D:\\scratch", results are printed as a table and can also
+be saved as JSON lines ("--output") to compare different revisions.
+Please note that the scripts use Windows folder names (".\\import"); on
+other platforms these folders are created with their literal names.
+The "phenoptrreports_consolidation_synchronizer" benchmark only works on
+Windows, since the script splits paths at backslashes. Runs with a non-zero
+exit code are reported without throughput (null rates in the JSON lines).
+The peak memory is measured by the script's own process, since the resource
+usage of child processes includes the memory of the parent process on Linux,
+see the "run_metrics" module for details.
+"""
+
+#  imports
+
+import argparse
+import json
+import os
+import platform
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_data
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from run_metrics import get_peak_memory  # pylint: disable=wrong-import-position
+
+#  functions
+
+
+def get_rows(size=0, bytes_per_row=1):
+    """Return the number of rows required to reach a given file size.
+
+    Keyword arguments:
+    size -- the target file size in bytes (default "0")
+    bytes_per_row -- the average number of bytes per row (default "1")
+    """
+    return max(1, round(size / bytes_per_row))
+
+
+def launch_script(script="", report=""):
+    """Run a script as the main module of the current process and write
+    the peak memory of the process to a report file.
+
+    Keyword arguments:
+    script -- the path to the script (default "")
+    report -- the path to the report file (default "")
+    """
+    sys.argv = [script]
+    sys.path[0] = os.path.dirname(script)  # import shared modules
+    try:
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        with open(report, "w", encoding="utf-8") as report_file:
+            report_file.write(str(get_peak_memory()))
+
+
+def parse_size(text=""):
+    """Return the number of bytes from a size with unit, e.g. "10MB" or "2.5GB".
+
+    Keyword arguments:
+    text -- the size with unit (default "")
+    """
+    text = text.strip().upper().rstrip("B")
+    for unit, factor in (("K", 1000), ("M", 1000**2), ("G", 1000**3), ("T", 1000**4)):
+        if text.endswith(unit):
+            return int(float(text[:-1]) * factor)
+    return int(float(text))
+
+
+def prepare_halo_splitter(folder="", size=0, images=0, columns=0, seed=0):
+    """Write a Total_Object_Results.csv file for the "HALO_TotalObjectResults_splitter"
+    and return the number of rows and bytes written as a tuple."""
+    import_folder = os.path.join(folder, r".\import")
+    os.makedirs(import_folder)
+    path = os.path.join(import_folder, "Study_Total_Object_Results.csv")
+    probe = synthetic_data.write_object_results(path, 1, PROBE_ROWS, columns, seed)
+    rows = get_rows(size, probe[1] / probe[0]) // images + 1
+    return synthetic_data.write_object_results(path, images, rows, columns, seed)
+
+
+def prepare_mergefile_splitter(folder="", size=0, images=0, columns=0, seed=0):
+    """Write a Merge_cell_seg_data.txt file for the "phenoptrreports_mergefile_splitter"
+    and return the number of rows and bytes written as a tuple."""
+    import_folder = os.path.join(folder, r".\import")
+    os.makedirs(import_folder)
+    path = os.path.join(import_folder, "Study_Merge_cell_seg_data.txt")
+    probe = synthetic_data.write_merge_file(path, 1, PROBE_ROWS, columns, seed)
+    rows = get_rows(size, probe[1] / probe[0]) // images + 1
+    return synthetic_data.write_merge_file(path, images, rows, columns, seed)
+
+
+def prepare_synchronizer(folder="", size=0, images=0, columns=0, seed=0):
+    """Write an export folder tree for the "phenoptrreports_consolidation_synchronizer"
+    and return the number of rows and bytes written as a tuple."""
+    path = os.path.join(folder, "probe.txt")
+    probe = synthetic_data.write_merge_file(path, 1, PROBE_ROWS, columns, seed)
+    os.remove(path)
+    channels = 3
+    rows = get_rows(size, probe[1] / probe[0]) // (2 * channels * images) + 1
+    return synthetic_data.write_channel_tree(
+        os.path.join(folder, r".\export"),
+        channels=channels,
+        samples=images,
+        rows=rows,
+        columns=columns,
+        seed=seed,
+    )
+
+
+def prepare_tileconfig(folder="", size=0, images=0, columns=0, seed=0):
+    """Write a folder of TIFF tiles for "write_tileconfig" and return
+    the number of tiles and bytes written as a tuple."""
+    pages = 4
+    pixels = 1024
+    tiles = max(1, round(size / (pages * pixels * pixels * 2)))
+    grid = max(1, round(tiles**0.5))
+    return synthetic_data.write_tiles(
+        folder, columns=grid, rows=-(-tiles // grid), pages=pages, pixels=pixels
+    )
+
+
+def run_script(script="", folder=""):
+    """Run a script in a separate process and return its exit code,
+    wall time in seconds, and peak memory in bytes as a tuple.
+
+    Keyword arguments:
+    script -- the path to the script (default "")
+    folder -- the working directory of the script (default "")
+    """
+    report = os.path.join(folder, "benchmark.rss")
+    with open(os.path.join(folder, "benchmark.log"), "wb") as log_file:
+        start = time.perf_counter()
+        exit_code = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--launch", script, report],
+            cwd=folder,
+            input=os.linesep.encode(),  # answer "Press ENTER" prompts
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            check=False,
+        ).returncode
+        wall = time.perf_counter() - start
+    try:
+        with open(report, "r", encoding="utf-8") as report_file:
+            peak = float(report_file.read())
+    except (OSError, ValueError):
+        peak = float("nan")
+    return (exit_code, wall, peak)
+
+
+#  constants & variables
+
+BENCHMARKS = {
+    "HALO_TotalObjectResults_splitter": prepare_halo_splitter,
+    "phenoptrreports_mergefile_splitter": prepare_mergefile_splitter,
+    "phenoptrreports_consolidation_synchronizer": prepare_synchronizer,
+    "write_tileconfig": prepare_tileconfig,
+}
+PROBE_ROWS = 1000  # rows written to estimate the bytes per row
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {
+    "HALO_TotalObjectResults_splitter": "HALO_TotalObjectResults_splitter.py",
+    "phenoptrreports_mergefile_splitter": "phenoptrreports_mergefile_splitter.py",
+    "phenoptrreports_consolidation_synchronizer": os.path.join(
+        "legacy", "phenoptrreports_consolidation_synchronizer.py"
+    ),
+    "write_tileconfig": "write_tileconfig.py",
+}
+VERSION = "run_benchmarks 1.0 (2024-10-21)"
+
+#  main program
+
+if __name__ == "__main__" and sys.argv[1:2] == ["--launch"]:
+    launch_script(script=sys.argv[2], report=sys.argv[3])
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=VERSION)
+    parser.add_argument("--benchmarks", nargs="+", default=list(BENCHMARKS))
+    parser.add_argument("--columns", type=int, default=40, help="marker columns")
+    parser.add_argument("--images", type=int, default=40, help="images or samples")
+    parser.add_argument("--keep", action="store_true", help="keep scratch folders")
+    parser.add_argument("--output", default="", help="append results as JSON lines")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per size")
+    parser.add_argument("--scratch", default=tempfile.gettempdir())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sizes", nargs="+", default=["10MB", "100MB", "1GB"])
+    arguments = parser.parse_args()
+
+    print(VERSION)
+    print(os.linesep)
+    print("BENCHMARKING scripts:")
+    print("-----------------------")
+    print(
+        f"{'SCRIPT':<44}{'SIZE':>8}{'EXIT':>6}{'TIME (s)':>10}"
+        f"{'ROWS/s':>12}{'MB/s':>9}{'RSS (MB)':>10}",
+        flush=True,
+    )
+    for size in arguments.sizes:
+        for benchmark in arguments.benchmarks:
+            for _run in range(arguments.repeat):
+                folder = tempfile.mkdtemp(prefix="himsr_", dir=arguments.scratch)
+                try:
+                    rows, data = BENCHMARKS[benchmark](
+                        folder=folder,
+                        size=parse_size(size),
+                        images=arguments.images,
+                        columns=arguments.columns,
+                        seed=arguments.seed,
+                    )
+                    exit_code, wall, rss = run_script(
+                        os.path.join(REPOSITORY, SCRIPTS[benchmark]), folder
+                    )
+                finally:
+                    if not arguments.keep:
+                        shutil.rmtree(folder, ignore_errors=True)
+                result = {
+                    "benchmark": benchmark,
+                    "size": size,
+                    "exit": exit_code,
+                    "rows": rows,
+                    "bytes": data,
+                    "seconds": wall,
+                    "rows_per_second": None if exit_code else rows / wall,
+                    "megabytes_per_second": None if exit_code else data / 1e6 / wall,
+                    "peak_rss_bytes": rss,
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                }
+                rates = f"{'-':>12}{'-':>9}"  # failed runs have no throughput
+                if not exit_code:
+                    rates = (
+                        f"{result['rows_per_second']:>12.0f}"
+                        f"{result['megabytes_per_second']:>9.1f}"
+                    )
+                print(
+                    f"{benchmark:<44}{size:>8}{exit_code:>6}{wall:>10.2f}"
+                    f"{rates}{rss / 1e6:>10.1f}",
+                    flush=True,
+                )
+                if arguments.output:
+                    with open(arguments.output, "a", encoding="utf-8") as out_file:
+                        out_file.write(json.dumps(result) + "\n")
+
+    print(os.linesep)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      synthetic_data
+Summary:    Generate synthetic input data for benchmarking the scripts
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+The generators write realistic, but synthetic, input data for each of
+the scripts in this repository:
+HALO's Total_Object_Results.csv files, inForm's Merge_cell_seg_data.txt
+files, inForm channel/batch folder trees with missing cell IDs, and
+folders of multi-page TIFF tiles with position tags.
+All generators are seeded, so the same parameters always produce the
+same data. Cell values are drawn from a small pool of pre-formatted
+columns, so that files with tens of gigabytes can be written at disk
+speed instead of being limited by the formatting of random numbers.
+Writing TIFF tiles requires the "tifffile" module, see "write_tileconfig".
+"""
+
+#  imports
+
+import os
+import random
+
+#  functions
+
+
+def get_marker_names(columns=0):
+    """Return a list of inForm-like marker column labels.
+
+    Keyword arguments:
+    columns -- the number of marker columns (default "0")
+    """
+    return [
+        COMPARTMENTS[column % len(COMPARTMENTS)]
+        + " "
+        + MARKERS[column // len(COMPARTMENTS) % len(MARKERS)]
+        + f" {column // (len(COMPARTMENTS) * len(MARKERS)) + 1}"
+        + " Mean (Normalized Counts, Total Weighting)"
+        for column in range(columns)
+    ]
+
+
+def get_sample_names(samples=0, msi=False, prefix="Study"):
+    """Return a list of inForm-like sample names, optionally with MSI coordinates.
+
+    Keyword arguments:
+    samples -- the number of samples (default "0")
+    msi -- append the MSI coordinates to the sample name (default "False")
+    prefix -- the prefix of the sample name (default "Study")
+    """
+    names = []
+    for sample in range(samples):
+        name = f"{prefix}_Slide{sample // 4:04d}"
+        if msi:
+            name += f"_[{40000 + (sample % 4) * 669},{12000 + sample * 502}]"
+        names.append(name)
+    return names
+
+
+def get_value_pool(rng=None, columns=0, size=1024, delimiter="\t"):
+    """Return a list of pre-formatted strings with random values for the marker columns.
+
+    Keyword arguments:
+    rng -- the random number generator (default "None")
+    columns -- the number of marker columns (default "0")
+    size -- the number of strings in the pool (default "1024")
+    delimiter -- the column delimiter (default "\\t")
+    """
+    return [
+        delimiter.join(
+            f"{rng.lognormvariate(1.0, 1.0):.4f}" for _column in range(columns)
+        )
+        for _string in range(size)
+    ]
+
+
+def write_cell_seg_data(
+    path="", sample_names=None, rows=0, columns=0, seed=0, missing=0.0, missing_seed=0
+):
+    """Write an inForm cell segmentation data file (tab-delimited) and return
+    the number of lines and bytes written as a tuple.
+    Lines with cell IDs are skipped with the probability of `missing`.
+
+    Keyword arguments:
+    path -- the path to the output file (default "")
+    sample_names -- the list of sample names with MSI coordinates (default "None")
+    rows -- the number of cells per sample (default "0")
+    columns -- the number of marker columns (default "0")
+    seed -- the seed for the random number generator (default "0")
+    missing -- the probability of a cell ID to be missing (default "0.0")
+    missing_seed -- the seed for selecting the missing cell IDs (default "0")
+    """
+    rng = random.Random(seed)
+    missing_rng = random.Random(missing_seed)
+    pool = get_value_pool(rng, columns, delimiter="\t")
+    lines = 0
+    with open(path, "w", encoding="utf-8", newline="\n") as out_file:
+        out_file.write("\t".join(INFORM_COLUMNS + get_marker_names(columns)) + "\n")
+        for sample_name in sample_names:
+            prefix = "C:\\inForm\\" + sample_name + "\t" + sample_name + "\t"
+            batch = []
+            for cell_id in range(1, rows + 1):
+                line = (
+                    prefix
+                    + TISSUE_CATEGORIES[cell_id % len(TISSUE_CATEGORIES)]
+                    + "\t"
+                    + PHENOTYPES[rng.randrange(len(PHENOTYPES))]
+                    + f"\t{cell_id}\t{rng.randrange(1872)}\t{rng.randrange(1404)}\t"
+                    + pool[rng.randrange(len(pool))]
+                    + "\n"
+                )
+                if missing and missing_rng.random() < missing:
+                    continue  # injected missing cell ID
+                batch.append(line)
+                if len(batch) == BATCH_LINES:
+                    out_file.writelines(batch)
+                    lines += len(batch)
+                    batch = []
+            out_file.writelines(batch)
+            lines += len(batch)
+    return (lines + 1, os.path.getsize(path))
+
+
+def write_channel_tree(
+    path="",
+    channels=3,
+    batches=1,
+    samples=10,
+    rows=0,
+    columns=0,
+    seed=0,
+    missing=0.001,
+    unmatched=0.1,
+):
+    """Write an inForm export folder tree with channel and batch folders for the
+    "phenoptrreports_consolidation_synchronizer" and return the number of lines
+    and bytes written as a tuple.
+    Each channel is missing cell IDs with the probability of `missing` and
+    individual files with the probability of `unmatched`, except the first channel.
+
+    Keyword arguments:
+    path -- the path to the export folder (default "")
+    channels -- the number of channel folders (default "3")
+    batches -- the number of batch folders per channel (default "1")
+    samples -- the number of sample files per batch (default "10")
+    rows -- the number of cells per sample file (default "0")
+    columns -- the number of marker columns (default "0")
+    seed -- the seed for the random number generator (default "0")
+    missing -- the probability of a cell ID to be missing (default "0.001")
+    unmatched -- the probability of a file to be missing (default "0.1")
+    """
+    rng = random.Random(seed)
+    lines = 0
+    size = 0
+    for channel in range(channels):
+        for batch in range(batches):
+            folder = os.path.join(path, f"channel {channel}", f"batch {batch}")
+            os.makedirs(folder, exist_ok=True)
+            names = get_sample_names(samples, msi=True, prefix=f"Batch{batch}")
+            for sample, name in enumerate(names):
+                if channel and rng.random() < unmatched:
+                    continue  # injected missing file
+                written = write_cell_seg_data(
+                    path=os.path.join(folder, name + "_cell_seg_data.txt"),
+                    sample_names=[name + ".im3"],
+                    rows=rows,
+                    columns=columns,
+                    seed=seed + batch * samples + sample,  # same cells in all channels
+                    missing=missing if channel else 0.0,
+                    missing_seed=rng.randrange(2**32),
+                )
+                lines += written[0]
+                size += written[1]
+            written = write_cell_seg_data(
+                path=os.path.join(folder, "Merge_cell_seg_data.txt"),
+                sample_names=[name + ".im3" for name in names],
+                rows=rows,
+                columns=columns,
+                seed=batch,
+            )
+            lines += written[0]
+            size += written[1]
+    return (lines, size)
+
+
+def write_merge_file(path="", samples=0, rows=0, columns=0, seed=0):
+    """Write an inForm Merge_cell_seg_data.txt file for the
+    "phenoptrreports_mergefile_splitter" and return the number of lines and
+    bytes written as a tuple.
+
+    Keyword arguments:
+    path -- the path to the output file (default "")
+    samples -- the number of samples (MSIs) (default "0")
+    rows -- the number of cells per sample (default "0")
+    columns -- the number of marker columns (default "0")
+    seed -- the seed for the random number generator (default "0")
+    """
+    names = [name + ".im3" for name in get_sample_names(samples, msi=True)]
+    return write_cell_seg_data(
+        path=path, sample_names=names, rows=rows, columns=columns, seed=seed
+    )
+
+
+def write_object_results(path="", images=0, rows=0, columns=0, seed=0):
+    """Write a HALO Total_Object_Results.csv file for the
+    "HALO_TotalObjectResults_splitter" and return the number of lines and
+    bytes written as a tuple.
+
+    Keyword arguments:
+    path -- the path to the output file (default "")
+    images -- the number of images (default "0")
+    rows -- the number of objects per image (default "0")
+    columns -- the number of marker columns (default "0")
+    seed -- the seed for the random number generator (default "0")
+    """
+    rng = random.Random(seed)
+    pool = get_value_pool(rng, columns, delimiter=",")
+    lines = 0
+    with open(path, "w", encoding="utf-8", newline="\n") as out_file:
+        out_file.write(
+            ",".join(
+                HALO_COLUMNS
+                + [label.replace(",", "") for label in get_marker_names(columns)]
+            )
+            + "\n"
+        )
+        for image in range(images):
+            prefix = f"D:\\HALO\\Study\\Image_{image:05d}.qptiff - resolution #1,"
+            prefix += "Layer 1,Analysis,"
+            batch = []
+            for object_id in range(rows):
+                x = rng.randrange(60000)
+                y = rng.randrange(40000)
+                batch.append(
+                    prefix
+                    + f"{object_id},{x},{x + 12},{y},{y + 11},"
+                    + pool[rng.randrange(len(pool))]
+                    + "\n"
+                )
+                if len(batch) == BATCH_LINES:
+                    out_file.writelines(batch)
+                    lines += len(batch)
+                    batch = []
+            out_file.writelines(batch)
+            lines += len(batch)
+    return (lines + 1, os.path.getsize(path))
+
+
+def write_tiles(path="", columns=4, rows=4, pages=4, pixels=512, overlap=0.1, seed=0):
+    """Write a grid of multi-page TIFF tiles with resolution and position tags for
+    "write_tileconfig" and return the number of tiles and bytes written as a tuple.
+
+    Keyword arguments:
+    path -- the path to the output folder (default "")
+    columns -- the number of tile columns (default "4")
+    rows -- the number of tile rows (default "4")
+    pages -- the number of pages (channels) per tile (default "4")
+    pixels -- the width and height of the tiles in pixels (default "512")
+    overlap -- the fraction of overlap between neighboring tiles (default "0.1")
+    seed -- the seed for the random number generator (default "0")
+    """
+    import numpy as np  # optional dependencies, only required for tiles
+    import tifffile as tifff
+
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 4096, size=(pages, pixels, pixels), dtype=np.uint16)
+    resolution = 20000  # pixels per centimeter (0.5 micron per pixel)
+    step = pixels * (1.0 - overlap) / resolution  # tile distance in centimeter
+    os.makedirs(path, exist_ok=True)
+    size = 0
+    for row in range(rows):
+        for column in range(columns):
+            file = os.path.join(path, f"Tile_r{row:03d}_c{column:03d}.tif")
+            tifff.imwrite(
+                file,
+                data,
+                photometric="minisblack",
+                resolution=(resolution, resolution),
+                resolutionunit="CENTIMETER",
+                extratags=[
+                    (286, 5, 1, (round(column * step * 100000), 100000), True),
+                    (287, 5, 1, (round(row * step * 100000), 100000), True),
+                ],
+            )
+            size += os.path.getsize(file)
+    return (rows * columns, size)
+
+
+#  constants & variables
+
+BATCH_LINES = 10000  # lines per write call
+COMPARTMENTS = ["Nucleus", "Cytoplasm", "Membrane", "Entire Cell"]
+HALO_COLUMNS = [
+    "Image Location",
+    "Analysis Region",
+    "Algorithm Name",
+    "Object Id",
+    "XMin",
+    "XMax",
+    "YMin",
+    "YMax",
+]
+INFORM_COLUMNS = [
+    "Path",
+    "Sample Name",
+    "Tissue Category",
+    "Phenotype",
+    "Cell ID",
+    "Cell X Position",
+    "Cell Y Position",
+]
+MARKERS = ["DAPI", "CD3", "CD8", "CD68", "FoxP3", "PD-L1", "PanCK"]
+PHENOTYPES = ["CD3+", "CD8+", "CD68+", "FoxP3+", "PanCK+", "Other"]
+TISSUE_CATEGORIES = ["Tumor", "Stroma"]
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      cell_table_cache
+Summary:    Cache merge files as memory-mappable column files
+            for repeated splitting and filtering
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+Merge files are parsed once into a cache folder next to the merge file
+("<merge file>.cache"), which contains:
+    meta.json       the column labels and types, the fingerprint of the
+                    merge file, and the vocabularies of text columns
+    offsets.bin     the byte offset of each line in the merge file
+    groups.bin      the runs of consecutive lines with the same group key
+    column_*.bin    one file per column: numbers as doubles, text as codes
+All binary files are native arrays that are memory-mapped when read, so
+that opening a cache and accessing a column does not parse any text.
+Columns are cached as numbers, if all of their values are numeric or
+missing (e.g. "#N/A"), else as text.
+The splitters use the cache, if it is present and the merge file did not
+change since the cache was built: Groups are then written by copying the
+byte ranges of their lines directly from the memory-mapped merge file and
+summarized from the cached columns, see the "summary_table" module.
+When run as a script, all merge files in the import folder are cached.
+"""
+
+#  imports
+
+import array
+import csv
+import itertools
+import json
+import locale
+import mmap
+import os
+import sys
+
+from file_discovery import get_files
+
+#  classes
+
+
+class CellTableCache:
+    """Reads a cached merge file with memory-mapped column files.
+
+    Keyword arguments:
+    in_path -- the path to the merge file (default "")
+    """
+
+    def __init__(self, in_path=""):
+        self.in_path = in_path
+        self.path = get_cache_path(in_path)
+        with open(os.path.join(self.path, "meta.json"), "r", encoding="utf-8") as meta:
+            self.meta = json.load(meta)
+        self.columns = [column["label"] for column in self.meta["columns"]]
+        self.encoding = self.meta["encoding"]
+        self.rows = self.meta["rows"]
+        self.maps = []  # memory maps, closed together
+        self.column_maps = {}  # mapped columns by index
+        self.source = self.map_file(in_path, "B")
+        self.offsets = self.map_file(os.path.join(self.path, "offsets.bin"), "Q")
+        self.groups = self.map_file(os.path.join(self.path, "groups.bin"), "Q")
+
+    def close(self):
+        """Release the memory maps of the cache and the merge file."""
+        self.source = self.offsets = self.groups = None
+        self.column_maps = {}
+        for memory_map in self.maps:
+            try:
+                memory_map.close()
+            except BufferError:  # column still in use, closed when released
+                continue
+        self.maps = []
+
+    def get_column(self, index=0):
+        """Return the values of a column as a memory-mapped view and, for text
+        columns, its vocabulary as a list - the values are codes into the list."""
+        if index not in self.column_maps:
+            column = self.meta["columns"][index]
+            path = os.path.join(self.path, f"column_{index}.bin")
+            if column["type"] == "number":
+                self.column_maps[index] = (self.map_file(path, "d"), None)
+            else:
+                self.column_maps[index] = (
+                    self.map_file(path, "I"),
+                    column["vocabulary"],
+                )
+        return self.column_maps[index]
+
+    def get_groups(self, get_key=None):
+        """Return a list of (key, first row, stop row) tuples for consecutive
+        rows with the same key. Keys are derived from the first line of each
+        run of the cached group column, adjacent runs with equal keys are joined.
+
+        Keyword arguments:
+        get_key -- the function returning the key of a line (default "None")
+        """
+        groups = []
+        for index in range(0, len(self.groups), 3):
+            start, stop = self.groups[index + 1], self.groups[index + 2]
+            key = get_key(self.get_line(start))
+            if groups and groups[-1][0] == key and groups[-1][2] == start:
+                groups[-1] = (key, groups[-1][1], stop)
+            else:
+                groups.append((key, start, stop))
+        return groups
+
+    def get_header(self):
+        """Return the header line of the merge file as bytes, without byte order mark."""
+        return bytes(self.source[: self.meta["data_start"]]).removeprefix(BOM)
+
+    def get_line(self, row=0):
+        """Return a line of the merge file as text."""
+        return self.get_rows(row, row + 1).tobytes().decode(self.encoding)
+
+    def get_numbers(self, index=0, start=0, stop=0):
+        """Return the values of a column for consecutive rows as a list of numbers,
+        non-numeric values are returned as NaN."""
+        values, vocabulary = self.get_column(index)
+        if vocabulary is None:
+            return values[start:stop].tolist()
+        numbers = [to_number(value) for value in vocabulary]
+        return [numbers[code] for code in values[start:stop]]
+
+    def get_rows(self, start=0, stop=0):
+        """Return the lines of consecutive rows as a view into the merge file."""
+        return self.source[self.offsets[start] : self.offsets[stop]]
+
+    def get_texts(self, index=0, start=0, stop=0):
+        """Return the values of a text column for consecutive rows as a list,
+        `None` for number columns - their text is not cached."""
+        values, vocabulary = self.get_column(index)
+        if vocabulary is None:
+            return None
+        return [vocabulary[code] for code in values[start:stop]]
+
+    def map_file(self, path="", typecode="B"):
+        """Memory-map a file read-only and return a typed view of its content."""
+        if not os.path.getsize(path):  # empty files can not be mapped
+            return memoryview(array.array(typecode))
+        with open(path, "rb") as mapped_file:
+            memory_map = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(memory_map)
+        return memoryview(memory_map).cast(typecode)
+
+
+#  functions
+
+
+def build_cache(in_path="", key_label="", encoding="utf-8", chunk_rows=1000):
+    """Parse a merge file into a cache folder and return the number of rows.
+    Columns are numbers, if all of their values are numeric or missing (see
+    `NA_VALUES`), else text - the key column is always text.
+
+    Keyword arguments:
+    in_path -- the path to the merge file (default "")
+    key_label -- the label of the column used to group rows (default "")
+    encoding -- the text encoding of the merge file, `None` for the locale's
+                (default "utf-8")
+    chunk_rows -- the number of rows parsed before writing (default "1000")
+    """
+    encoding = encoding or locale.getpreferredencoding(False)  # like `open()`
+    path = get_cache_path(in_path)
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):  # invalidate previous cache first
+        os.remove(meta_path)
+    for cache_file in get_files(path):  # column files are appended to
+        os.remove(cache_file)
+    stat = os.stat(in_path)
+    with open(in_path, "rb") as in_file:
+        header = in_file.readline()
+        labels = header.removeprefix(BOM).decode(encoding).rstrip("\r\n")
+        delimiter = "\t" if labels.count("\t") >= labels.count(",") else ","
+        labels = split_line(labels, delimiter)
+        key_index = labels.index(key_label) if key_label in labels else 0
+        columns = [{"label": label, "type": "number"} for label in labels]
+        columns[key_index]["type"] = "text"  # keys are compared by their codes
+        vocabularies = [{} for _label in labels]
+        offsets = array.array("Q", [len(header)])
+        groups = array.array("Q")
+        rows = 0
+        previous_key = None
+        while True:
+            lines = list(itertools.islice(in_file, chunk_rows))
+            if not lines:
+                break
+            offsets.extend(
+                itertools.islice(
+                    itertools.accumulate(map(len, lines), initial=offsets[-1]), 1, None
+                )
+            )
+            table = [
+                split_line(line.decode(encoding).rstrip("\r\n"), delimiter)
+                for line in lines
+            ]
+            if min(map(len, table)) < len(labels):  # short lines
+                for row in table:
+                    row += [""] * (len(labels) - len(row))
+            values = list(itertools.islice(zip(*table), len(labels)))
+            chunks = [None for _label in labels]
+            retyped = []  # number columns with text values
+            for index, column in enumerate(columns):
+                if column["type"] == "number":
+                    chunks[index] = to_numbers(values[index])
+                    if chunks[index] is None:
+                        column["type"] = "text"
+                        retyped.append(index)
+            if rows and retyped:  # encode previous rows as text
+                previous = [None for _label in labels]
+                for index, texts in zip(
+                    retyped,
+                    read_columns(
+                        in_path, retyped, len(header), rows, encoding, delimiter
+                    ),
+                ):
+                    os.remove(os.path.join(path, f"column_{index}.bin"))
+                    previous[index] = to_codes(texts, vocabularies[index])
+                write_chunks(path, previous)
+            for index, chunk in enumerate(chunks):
+                if chunk is None:
+                    chunks[index] = to_codes(values[index], vocabularies[index])
+            write_chunks(path, chunks)
+            for key in chunks[key_index]:
+                if key != previous_key:  # new run of group keys
+                    groups.extend((key, rows, rows + 1))
+                    previous_key = key
+                else:
+                    groups[-1] = rows + 1
+                rows += 1
+    for index, column in enumerate(columns):
+        column_path = os.path.join(path, f"column_{index}.bin")
+        if not rows:  # empty merge file
+            open(column_path, "wb").close()
+        if column["type"] == "text":
+            column["vocabulary"] = list(vocabularies[index])
+    for name, data in (("offsets.bin", offsets), ("groups.bin", groups)):
+        with open(os.path.join(path, name), "wb") as out_file:
+            data.tofile(out_file)
+    with open(meta_path, "w", encoding="utf-8") as meta:  # written last, marks valid
+        json.dump(
+            {
+                "version": CACHE_VERSION,
+                "source": [stat.st_size, stat.st_mtime_ns],
+                "byteorder": sys.byteorder,
+                "encoding": encoding,
+                "delimiter": delimiter,
+                "data_start": len(header),
+                "rows": rows,
+                "key": labels[key_index],
+                "columns": columns,
+            },
+            meta,
+        )
+    return rows
+
+
+def get_cache_path(in_path=""):
+    """Return the path to the cache folder of a merge file.
+
+    Keyword arguments:
+    in_path -- the path to the merge file (default "")
+    """
+    return in_path + ".cache"
+
+
+def is_valid(in_path=""):
+    """Return whether a merge file has a cache that matches its current version.
+
+    Keyword arguments:
+    in_path -- the path to the merge file (default "")
+    """
+    try:
+        with open(
+            os.path.join(get_cache_path(in_path), "meta.json"), "r", encoding="utf-8"
+        ) as meta_file:
+            meta = json.load(meta_file)
+        stat = os.stat(in_path)
+    except (OSError, ValueError):
+        return False
+    return (
+        meta.get("version") == CACHE_VERSION
+        and meta.get("byteorder") == sys.byteorder
+        and meta.get("source") == [stat.st_size, stat.st_mtime_ns]
+    )
+
+
+def open_cache(in_path=""):
+    """Return the cache of a merge file, if present and valid, else `None`.
+
+    Keyword arguments:
+    in_path -- the path to the merge file (default "")
+    """
+    return CellTableCache(in_path) if is_valid(in_path) else None
+
+
+def read_columns(
+    in_path="", indices=(), start=0, rows=0, encoding="utf-8", delimiter="\t"
+):
+    """Return the text values of the first rows of a merge file for each column
+    index, short lines are padded with empty values.
+
+    Keyword arguments:
+    in_path -- the path to the merge file (default "")
+    indices -- the indices of the columns (default "")
+    start -- the byte offset of the first row (default "0")
+    rows -- the number of rows (default "0")
+    encoding -- the text encoding of the merge file (default "utf-8")
+    delimiter -- the column delimiter (default "\\t")
+    """
+    columns = [[] for _index in indices]
+    with open(in_path, "rb") as in_file:
+        in_file.seek(start)
+        for line in itertools.islice(in_file, rows):
+            values = split_line(line.decode(encoding).rstrip("\r\n"), delimiter)
+            for column, index in zip(columns, indices):
+                column.append(values[index] if index < len(values) else "")
+    return columns
+
+
+def split_line(line="", delimiter="\t"):
+    """Split a line of text into its column values, quoted if comma-separated.
+
+    Keyword arguments:
+    line -- the line of text without line ending (default "")
+    delimiter -- the column delimiter (default "\\t")
+    """
+    if delimiter == "," and '"' in line:
+        return next(csv.reader([line]))
+    return line.split(delimiter)
+
+
+def to_codes(values=(), vocabulary=None):
+    """Convert text values to an array of codes, new values are added to the
+    vocabulary.
+
+    Keyword arguments:
+    values -- the text values (default "")
+    vocabulary -- the dictionary of codes by value (default "None")
+    """
+    return array.array(
+        "I", [vocabulary.setdefault(value, len(vocabulary)) for value in values]
+    )
+
+
+def to_number(value=""):
+    """Convert a text value to a number, non-numeric values are returned as NaN.
+
+    Keyword arguments:
+    value -- the text value (default "")
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return float("nan")
+
+
+def to_numbers(values=()):
+    """Convert text values to an array of numbers, missing values are returned
+    as NaN - returns `None` if any other value is not numeric.
+
+    Keyword arguments:
+    values -- the text values (default "")
+    """
+    try:
+        return array.array("d", map(float, values))
+    except ValueError:  # slow path
+        numbers = array.array("d")
+        for value in values:
+            try:
+                numbers.append(float(value))
+            except ValueError:
+                if value.strip() not in NA_VALUES:
+                    return None
+                numbers.append(float("nan"))
+        return numbers
+
+
+def write_chunks(path="", chunks=None):
+    """Append the parsed chunks of rows to the column files of a cache.
+
+    Keyword arguments:
+    path -- the path to the cache folder (default "")
+    chunks -- the list of arrays with the values of each column (default "None")
+    """
+    for index, chunk in enumerate(chunks):
+        if chunk is None:
+            continue
+        with open(os.path.join(path, f"column_{index}.bin"), "ab") as column_file:
+            chunk.tofile(column_file)
+
+
+#  constants & variables
+
+BOM = b"\xef\xbb\xbf"  # UTF-8 byte order mark
+CACHE_VERSION = 2
+FILE_TARGETS = ["*Merge_cell_seg_data.txt", "*Total_Object_Results.csv"]
+IMPORT_FOLDER = r".\import"
+KEY_LABELS = {"txt": "Sample Name", "csv": "Image Location"}  # group columns
+NA_VALUES = {"", "#N/A", "N/A", "NA", "NaN", "null"}  # missing numbers
+VERSION = "cell_table_cache 1.0 (2024-10-22)"
+
+#  main program
+
+if __name__ == "__main__":
+    print(VERSION)
+    print(os.linesep)
+    print("CACHING files in folder:")
+    print("-----------------------")
+    print('FILE: "' + '", "'.join(FILE_TARGETS) + '"')
+    FILE_COUNT = 0
+
+    for file in get_files(IMPORT_FOLDER, include=FILE_TARGETS):
+        print('\tFILE: "' + file + '"', flush=True)
+        if is_valid(file):
+            print("\t\tVALID")
+            continue
+        LINES = build_cache(
+            in_path=file,
+            key_label=KEY_LABELS[file.rsplit(".", 1)[-1].lower()],
+            encoding="utf-8" if file.lower().endswith(".csv") else None,
+        )
+        print("\t\tLINES: " + str(LINES))
+        FILE_COUNT += 1
+
+    print("FILES: " + str(FILE_COUNT))
+    print(os.linesep)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      fcs_reader
+Summary:    Memory-map flow cytometry standard files and verify
+            their content against the original text files
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+Please install the latest version of the "numpy" module with "conda"
+("conda install numpy") or "pip" ("pip install numpy").
+The reader parses the HEADER and TEXT segments of FCS 3.0/3.1 files and
+maps the DATA segment into memory as a structured array - one field per
+parameter ($PnN). Nothing is read or copied until a column is accessed,
+so even very large files open instantly and each column is only a
+strided view into the file.
+When run as a script, every FCS file in the export folder is compared
+against the text file of the same name in the import folder, as written
+by the "csv-2-fcs.R" script. Instead of converting the FCS files back into
+text files ("revertResult"), the text file is read in chunks of rows and
+compared column by column against the mapped data. Each chunk is parsed
+by numpy at once, chunks with non-numeric values are parsed value by value.
+Non-numeric values in the text file are expected as zeros ("replaceNA"),
+columns that are not present in the FCS file are ignored.
+"""
+
+#  imports
+
+import csv
+import fnmatch
+import itertools
+import os
+
+import numpy as np
+
+#  functions
+
+
+def get_data_dtype(keywords=None):
+    """Return the structured data type of the DATA segment from the TEXT keywords.
+
+    Keyword arguments:
+    keywords -- the dictionary with the TEXT segment keywords (default "None")
+    """
+    if keywords.get("$MODE", "L").upper() != "L":
+        raise ValueError("Only list mode ($MODE L) data is supported.")
+    byte_order = keywords.get("$BYTEORD", "4,3,2,1").replace(" ", "")
+    endian = "<" if byte_order in ("1,2,3,4", "1,2") else ">"
+    data_type = keywords["$DATATYPE"].upper()
+    names = []
+    formats = []
+    for parameter in range(1, int(keywords["$PAR"]) + 1):
+        names.append(keywords["$P" + str(parameter) + "N"])
+        bits = int(keywords["$P" + str(parameter) + "B"])
+        if data_type == "F":
+            formats.append(endian + "f4")
+        elif data_type == "D":
+            formats.append(endian + "f8")
+        elif data_type == "I" and bits in (8, 16, 32, 64):
+            formats.append(endian + "u" + str(bits // 8))
+        else:
+            raise ValueError(
+                "Unsupported data type: $DATATYPE " + data_type + ", $PnB " + str(bits)
+            )
+    return np.dtype({"names": names, "formats": formats})
+
+
+def get_header(path=""):
+    """Read the HEADER segment of an FCS file and return its version and
+    the byte offsets of the TEXT and DATA segments as a tuple.
+
+    Keyword arguments:
+    path -- the path to the FCS file (default "")
+    """
+    with open(path, "rb") as fcs_file:
+        header = fcs_file.read(58)
+    version = header[0:6].decode("ascii")
+    if not version.startswith("FCS"):
+        raise ValueError('Not an FCS file: "' + path + '"')
+    offsets = [int(header[start : start + 8] or 0) for start in range(10, 58, 8)]
+    return (version, offsets[0], offsets[1], offsets[2], offsets[3])
+
+
+def get_keywords(segment=b""):
+    """Parse the TEXT segment of an FCS file and return its keywords as a dictionary.
+    Delimiters within keywords or values are escaped by doubling them.
+
+    Keyword arguments:
+    segment -- the TEXT segment including its leading delimiter (default "")
+    """
+    text = segment.decode("utf-8", errors="replace")
+    delimiter = text[0]
+    fields = []
+    field = []
+    index = 1
+    while index < len(text):
+        character = text[index]
+        if character == delimiter:
+            if index + 1 < len(text) and text[index + 1] == delimiter:
+                field.append(delimiter)  # escaped delimiter
+                index += 1
+            else:  # end of field
+                fields.append("".join(field))
+                field = []
+        else:
+            field.append(character)
+        index += 1
+    if field:  # missing trailing delimiter
+        fields.append("".join(field))
+    return {fields[i].upper(): fields[i + 1] for i in range(0, len(fields) - 1, 2)}
+
+
+def get_text_delimiter(line=""):
+    """Guess the delimiter of a text file from its header line.
+
+    Keyword arguments:
+    line -- the header line of the text file (default "")
+    """
+    return "\t" if line.count("\t") >= line.count(",") else ","
+
+
+def map_data(path=""):
+    """Memory-map the DATA segment of an FCS file and return its keywords
+    and a read-only structured view of its events as a tuple.
+    Columns are accessed by parameter name without copying the data.
+
+    Keyword arguments:
+    path -- the path to the FCS file (default "")
+    """
+    _version, text_begin, text_end, data_begin, data_end = get_header(path)
+    with open(path, "rb") as fcs_file:
+        fcs_file.seek(text_begin)
+        keywords = get_keywords(fcs_file.read(text_end - text_begin + 1))
+    if not data_begin or not data_end:  # offsets larger than 99,999,999 bytes
+        data_begin = int(keywords["$BEGINDATA"])
+        data_end = int(keywords["$ENDDATA"])
+    dtype = get_data_dtype(keywords)
+    events = int(keywords["$TOT"])
+    if events * dtype.itemsize > data_end - data_begin + 1:
+        raise ValueError('DATA segment shorter than expected: "' + path + '"')
+    data = np.memmap(path, dtype=dtype, mode="r", offset=data_begin, shape=(events,))
+    return (keywords, data)
+
+
+def read_table(lines=None, delimiter=",", usecols=()):
+    """Parse lines of a text file into a float array with one column per index,
+    non-numeric values are replaced with zeros and missing values of blank or
+    short lines with NaN. The lines are parsed by numpy at once and only value
+    by value, if they contain non-numeric or missing values.
+
+    Keyword arguments:
+    lines -- the list of lines to parse (default "None")
+    delimiter -- the column delimiter (default ",")
+    usecols -- the indices of the columns to parse (default "")
+    """
+    if not lines or not usecols:
+        return np.zeros((len(lines), len(usecols)))
+    try:
+        table = np.loadtxt(
+            lines,
+            dtype=np.float64,
+            comments=None,
+            delimiter=delimiter,
+            quotechar='"',
+            usecols=usecols,
+            ndmin=2,
+        )
+    except ValueError:  # non-numeric values or short lines, slow path
+        table = None
+    if table is not None and len(table) == len(lines):  # blank lines are skipped
+        table[np.isnan(table)] = 0.0
+        return table
+    return np.array(
+        [
+            [to_float(row[index]) if index < len(row) else np.nan for index in usecols]
+            for row in csv.reader(lines, delimiter=delimiter)
+        ],
+        dtype=np.float64,
+    )
+
+
+def to_float(value=""):
+    """Convert a text value to float, non-numeric values are replaced with zero.
+
+    Keyword arguments:
+    value -- the text value to convert (default "")
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return 0.0
+    return 0.0 if number != number else number  # NaN
+
+
+def verify_data(fcs_path="", text_path="", chunk_rows=1000000):
+    """Compare the mapped data of an FCS file column by column against
+    the original text file and return the number of rows compared and
+    a dictionary with the number of mismatches per column as a tuple.
+
+    Keyword arguments:
+    fcs_path -- the path to the FCS file (default "")
+    text_path -- the path to the original text file (default "")
+    chunk_rows -- the number of rows compared at a time (default "1000000")
+    """
+    _keywords, data = map_data(fcs_path)
+    mismatches = {}
+    with open(text_path, "r", encoding="utf-8-sig", newline="") as text_file:
+        header = text_file.readline()
+        delimiter = get_text_delimiter(header)
+        labels = next(csv.reader([header], delimiter=delimiter))
+        indices = {label: index for index, label in enumerate(labels)}
+        columns = [name for name in data.dtype.names if name in indices]
+        for name in data.dtype.names:
+            if name not in indices:  # parameter missing in text file
+                mismatches[name] = len(data)
+        usecols = [indices[name] for name in columns]
+        rows = 0
+        while True:
+            chunk = list(itertools.islice(text_file, chunk_rows))
+            if not chunk:
+                break
+            if rows + len(chunk) > len(data):  # more rows than events
+                mismatches["$TOT"] = rows + len(chunk) - len(data)
+                chunk = chunk[: len(data) - rows]
+            table = read_table(chunk, delimiter, usecols)
+            missing = np.isnan(table)  # values of blank or short lines
+            if missing.any():
+                table[missing] = 0.0
+            for position, name in enumerate(columns):
+                column = data[name][rows : rows + len(chunk)]  # view, no copy
+                expected = table[:, position].astype(
+                    column.dtype.newbyteorder("="), copy=False
+                )
+                count = int(
+                    np.count_nonzero((column != expected) | missing[:, position])
+                )
+                if count:
+                    mismatches[name] = mismatches.get(name, 0) + count
+            rows += len(chunk)
+            if "$TOT" in mismatches:
+                break
+    if rows < len(data):  # fewer rows than events
+        mismatches["$TOT"] = len(data) - rows
+    return (rows, mismatches)
+
+
+#  constants & variables
+
+CHUNK_ROWS = 1000000  # rows compared at a time
+EXPORT_FOLDER = os.path.join(os.getcwd(), "export")
+FILE_TARGET = "*.fcs"
+IMPORT_EXTENSIONS = (".csv", ".tsv", ".txt")  # see `importPattern` in "csv-2-fcs.R"
+IMPORT_FOLDER = os.path.join(os.getcwd(), "import")
+VERSION = "fcs_reader 1.0 (2024-10-21)"
+
+#  main program
+
+if __name__ == "__main__":
+    print(VERSION)
+    print(os.linesep)
+    print("VERIFYING files in folder:")
+    print("-----------------------")
+    print('FILE: "' + FILE_TARGET + '"')
+    FILE_COUNT = 0
+    FAILED_COUNT = 0
+
+    for file in sorted(os.listdir(EXPORT_FOLDER)):
+        if not fnmatch.fnmatch(file.lower(), FILE_TARGET):
+            continue
+        stem = os.path.splitext(file)[0]
+        sources = [
+            os.path.join(IMPORT_FOLDER, source)
+            for source in os.listdir(IMPORT_FOLDER)
+            if os.path.splitext(source)[0] == stem
+            and os.path.splitext(source)[1].lower() in IMPORT_EXTENSIONS
+        ]
+        print('\tFILE: "' + file + '"', flush=True)
+        if not sources:
+            print("\t\tSOURCE: MISSING")
+            FAILED_COUNT += 1
+            continue
+        print('\t\tSOURCE: "' + os.path.basename(sources[0]) + '"', flush=True)
+        compared, differences = verify_data(
+            fcs_path=os.path.join(EXPORT_FOLDER, file),
+            text_path=sources[0],
+            chunk_rows=CHUNK_ROWS,
+        )
+        print("\t\tROWS: " + str(compared), "MISMATCHES: " + str(len(differences)))
+        for column, count in differences.items():
+            print('\t\t\t"' + column + '": ' + str(count))
+        if differences:
+            FAILED_COUNT += 1
+        FILE_COUNT += 1
+
+    print("FILES: " + str(FILE_COUNT), "FAILED: " + str(FAILED_COUNT))
+    print(os.linesep)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      file_discovery
+Summary:    Find files and folders in large folder structures
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+This module is used by the scripts to find their input files and folders.
+Folders are listed with `os.scandir()` and the file type information of
+its entries is reused, so that no additional system call is required per
+file - this matters most on network shares with high latencies.
+When searching recursively, subfolders are listed in parallel by a pool
+of threads and the results are yielded as soon as each folder has been
+listed, without building nested lists.
+Symbolic links are skipped. Names are matched against sets of include and
+exclude patterns (glob-style, e.g. "*.tif"), following the case-sensitivity
+of the operating system.
+"""
+
+#  imports
+
+import concurrent.futures
+import fnmatch
+import os
+import re
+
+#  functions
+
+
+def get_files(path="", include=("*",), exclude=(), recursive=False, workers=0):
+    """Return a sorted list of files in a folder (structure) matching the patterns.
+
+    Keyword arguments:
+    path -- the path to the folder containing the files (default "")
+    include -- the patterns of which the file name must match one (default "*")
+    exclude -- the patterns of which the file name may not match any (default "")
+    recursive -- search the subfolders, too (default "False")
+    workers -- the number of threads listing subfolders (default "WORKERS")
+    """
+    return sorted(iter_files(path, include, exclude, recursive, workers))
+
+
+def get_folders(path="", include=("*",), exclude=(), recursive=False, workers=0):
+    """Return a sorted list of folders in a folder (structure) matching the patterns.
+    Excluded folders are not searched recursively.
+
+    Keyword arguments:
+    path -- the path to the folder containing the folders (default "")
+    include -- the patterns of which the folder name must match one (default "*")
+    exclude -- the patterns of which the folder name may not match any (default "")
+    recursive -- search the subfolders, too (default "False")
+    workers -- the number of threads listing subfolders (default "WORKERS")
+    """
+    return sorted(iter_folders(path, include, exclude, recursive, workers))
+
+
+def get_matcher(patterns=()):
+    """Return a function that matches a name against any of the glob-style patterns.
+
+    Keyword arguments:
+    patterns -- the glob-style patterns (default "")
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not patterns:
+        return lambda name: False
+    expression = re.compile(
+        "|".join(fnmatch.translate(os.path.normcase(pattern)) for pattern in patterns)
+    )
+    return lambda name: expression.match(os.path.normcase(name)) is not None
+
+
+def iter_files(path="", include=("*",), exclude=(), recursive=False, workers=0):
+    """Yield the paths of files in a folder (structure) matching the patterns.
+
+    Keyword arguments:
+    path -- the path to the folder containing the files (default "")
+    include -- the patterns of which the file name must match one (default "*")
+    exclude -- the patterns of which the file name may not match any (default "")
+    recursive -- search the subfolders, too (default "False")
+    workers -- the number of threads listing subfolders (default "WORKERS")
+    """
+    included = get_matcher(include)
+    excluded = get_matcher(exclude)
+    for files, _folders in walk(path, recursive, lambda folder: True, workers):
+        for file in files:
+            if included(file.name) and not excluded(file.name):
+                yield file.path
+
+
+def iter_folders(path="", include=("*",), exclude=(), recursive=False, workers=0):
+    """Yield the paths of folders in a folder (structure) matching the patterns.
+    Excluded folders are not searched recursively.
+
+    Keyword arguments:
+    path -- the path to the folder containing the folders (default "")
+    include -- the patterns of which the folder name must match one (default "*")
+    exclude -- the patterns of which the folder name may not match any (default "")
+    recursive -- search the subfolders, too (default "False")
+    workers -- the number of threads listing subfolders (default "WORKERS")
+    """
+    included = get_matcher(include)
+    excluded = get_matcher(exclude)
+
+    def descend(folder):
+        return not excluded(folder.name)
+
+    for _files, folders in walk(path, recursive, descend, workers):
+        for folder in folders:
+            if included(folder.name) and not excluded(folder.name):
+                yield folder.path
+
+
+def scan_folder(path=""):
+    """List a folder and return its file and folder entries as a tuple of lists.
+    Symbolic links are skipped.
+
+    Keyword arguments:
+    path -- the path to the folder (default "")
+    """
+    files = []
+    folders = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry)
+            elif entry.is_file(follow_symlinks=False):
+                files.append(entry)
+    return (files, folders)
+
+
+def walk(path="", recursive=False, descend=None, workers=0):
+    """Yield the file and folder entries of a folder (structure) as tuples of lists,
+    one tuple per folder listed. Subfolders are listed in parallel.
+
+    Keyword arguments:
+    path -- the path to the top folder (default "")
+    recursive -- list the subfolders, too (default "False")
+    descend -- the function deciding whether to list a subfolder (default "None")
+    workers -- the number of threads listing subfolders (default "WORKERS")
+    """
+    files, folders = scan_folder(path)
+    yield (files, folders)
+    if not recursive:
+        return
+    folders = [folder for folder in folders if descend(folder)]
+    if (workers or WORKERS) < 2:  # iterative, depth-first
+        while folders:
+            files, subfolders = scan_folder(folders.pop().path)
+            yield (files, subfolders)
+            folders.extend(folder for folder in subfolders if descend(folder))
+        return
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or WORKERS)
+    try:
+        pending = {executor.submit(scan_folder, folder.path) for folder in folders}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                files, subfolders = future.result()
+                yield (files, subfolders)
+                for folder in subfolders:
+                    if descend(folder):
+                        pending.add(executor.submit(scan_folder, folder.path))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+#  constants & variables
+
+WORKERS = 16  # threads listing subfolders, mostly waiting for the file system
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      io_pipeline
+Summary:    Overlap reading, parsing, and writing of text files
+            with background threads
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+This module is used by the scripts to read and write large text files on
+network shares, where each read or write waits for the latency of the
+share: A reader thread reads ahead in large blocks while the lines of the
+previous blocks are parsed, and a pool of writer threads writes the
+output files with large buffers while the next lines are parsed.
+Both stages are connected by bounded queues, so that a slow stage holds
+back the others instead of filling up the memory. Lines are returned like
+from a file opened in text mode (universal newlines), all writes to the
+same path are done by the same writer thread in the order submitted.
+"""
+
+#  imports
+
+import codecs
+import io
+import locale
+import queue
+import threading
+
+#  classes
+
+
+class WriterPool:
+    """Writes files in the background with a pool of threads, one queue per thread.
+    Use as a context manager or call `close()` to wait for all writes.
+
+    Keyword arguments:
+    workers -- the number of writer threads (default "WRITERS")
+    queue_size -- the maximum number of pending writes per thread (default "QUEUE_SIZE")
+    buffering -- the size of the write buffer per file in bytes (default "WRITE_BUFFER")
+    """
+
+    def __init__(self, workers=0, queue_size=0, buffering=0):
+        self.buffering = buffering or WRITE_BUFFER
+        self.error = None  # first error of any writer thread
+        self.queues = [
+            queue.Queue(maxsize=queue_size or QUEUE_SIZE)
+            for _worker in range(workers or WRITERS)
+        ]
+        self.threads = [
+            threading.Thread(target=self.run, args=(jobs,), daemon=True)
+            for jobs in self.queues
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        """Wait for all pending writes, close all files, and raise the first error."""
+        for jobs in self.queues:
+            jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queues, self.threads = [], []
+        if self.error:
+            raise self.error
+
+    def run(self, jobs=None):
+        """Write the jobs from a queue until `None` is received."""
+        files = {}  # open files by path
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            path, data, mode, encoding, close = job
+            if self.error:  # discard remaining jobs
+                continue
+            try:
+                if path not in files:
+                    files[path] = open(
+                        path, mode, buffering=self.buffering, encoding=encoding
+                    )
+                files[path].writelines(data)
+                if close:
+                    files.pop(path).close()
+            except (OSError, ValueError) as error:
+                self.error = error
+        for out_file in files.values():
+            out_file.close()
+
+    def write(self, path="", data=(), mode="w", encoding=None, close=False):
+        """Submit data to be written to a file, blocks if the writer is behind.
+        The file is opened with `mode` by the first write and kept open until a
+        write with `close` - don't modify `data` after submitting it.
+
+        Keyword arguments:
+        path -- the path to the file (default "")
+        data -- the list of strings (text mode) or bytes (binary mode) (default "")
+        mode -- the mode to open the file with (default "w")
+        encoding -- the text encoding of the file (default "None")
+        close -- close the file after writing (default "False")
+        """
+        if self.error:
+            raise self.error
+        worker = hash(path) % len(self.queues)  # same path, same thread
+        self.queues[worker].put((path, data, mode, encoding, close))
+
+
+#  functions
+
+
+def iter_lines(path="", encoding=None, block_size=0, prefetch=0):
+    """Yield the lines of a text file like iterating over `open(path, "r")`, while
+    a reader thread reads ahead in large blocks.
+
+    Keyword arguments:
+    path -- the path to the text file (default "")
+    encoding -- the text encoding, `None` for the locale's (default "None")
+    block_size -- the size of the blocks read in bytes (default "READ_BLOCK")
+    prefetch -- the maximum number of blocks read ahead (default "PREFETCH_BLOCKS")
+    """
+    blocks = queue.Queue(maxsize=prefetch or PREFETCH_BLOCKS)
+    stop = threading.Event()
+    reader = threading.Thread(
+        target=read_blocks,
+        args=(path, block_size or READ_BLOCK, blocks, stop),
+        daemon=True,
+    )
+    reader.start()
+    decoder = io.IncrementalNewlineDecoder(  # like `io.TextIOWrapper`
+        codecs.getincrementaldecoder(encoding or locale.getpreferredencoding(False))(),
+        translate=True,
+    )
+    tail = ""  # incomplete last line
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            lines = (tail + decoder.decode(block, final=not block)).split("\n")
+            tail = lines.pop()
+            yield from [line + "\n" for line in lines]
+            if not block:
+                break
+        if tail:
+            yield tail
+    finally:
+        stop.set()
+        reader.join()
+
+
+def put_item(items=None, item=None, stop=None):
+    """Put an item into a bounded queue, unless the consumer stopped.
+
+    Keyword arguments:
+    items -- the queue (default "None")
+    item -- the item to put into the queue (default "None")
+    stop -- the event set by the consumer when stopping (default "None")
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def read_blocks(path="", block_size=0, blocks=None, stop=None):
+    """Read a file in blocks into a queue, an empty block marks the end of file.
+
+    Keyword arguments:
+    path -- the path to the file (default "")
+    block_size -- the size of the blocks in bytes (default "0")
+    blocks -- the bounded queue receiving the blocks or an error (default "None")
+    stop -- the event set by the consumer when stopping (default "None")
+    """
+    try:
+        with open(path, "rb", buffering=0) as in_file:
+            while not stop.is_set():
+                block = in_file.read(block_size)
+                put_item(blocks, block, stop)
+                if not block:
+                    return
+    except OSError as error:
+        put_item(blocks, error, stop)
+
+
+#  constants & variables
+
+CHUNK_LINES = 10000  # lines per write, when writing line by line
+PREFETCH_BLOCKS = 4  # blocks read ahead
+QUEUE_SIZE = 4  # pending writes per writer thread
+READ_BLOCK = 4194304  # bytes per read
+WRITE_BUFFER = 1048576  # bytes buffered per file
+WRITERS = 4  # writer threads, mostly waiting for the file system
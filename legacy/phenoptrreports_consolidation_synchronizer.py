@@ -64,6 +64,19 @@ identify consensus regions for different batches.
 Both unmatched (non-consensus) channel files as well as unbalanced
 files with surplus lines are moved into subfolders of their
 corresponding batch folders.
+Run metrics are recorded with the "run_metrics" module in the parent folder,
+use the "--quiet" option to skip progress messages for large data sets.
+Line counts are kept in a manifest in the export folder, so that only new
+or changed files are counted again in later runs, see "run_manifest".
+Unbalanced files are read ahead and balanced files are written in the
+background, see "io_pipeline".
+Optionally, cells are paired with the reference by their cell ID and X/Y
+position within a tolerance, so that files with cells renumbered between
+channels are synchronized instead of losing all lines after the first
+renumbered cell: The reference cells are binned per image into a grid
+with the size of the tolerance (spatial hash), so that each cell is only
+compared with reference cells in its neighboring bins. Balanced files
+are then written in the line order and with the cell IDs of the reference.
 """
 
 #  imports
@@ -72,17 +85,13 @@ import os
 import shutil
 import sys
 
-#  functions
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from file_discovery import get_files, get_folders  # pylint: disable=wrong-import-position
+from io_pipeline import CHUNK_LINES, WriterPool, iter_lines  # pylint: disable=wrong-import-position
+from run_manifest import RunManifest, get_manifest_file  # pylint: disable=wrong-import-position
+from run_metrics import RunMetrics  # pylint: disable=wrong-import-position
 
-def flatten(deep_list=None):
-    """ Returns a flattened list with elements from (deep) lists or tuples """
-    flat_list = []
-    for item in deep_list:
-        if isinstance(item, (list, tuple)):
-            flat_list.extend(flatten(item))
-        else:
-            flat_list.append(item)
-    return flat_list
+#  functions
 
 def get_cell_ids(path='/home/user/', length=None):
     """ Returns the cell IDs of a file as a list with given length. """
@@ -95,34 +104,31 @@ def get_cell_ids(path='/home/user/', length=None):
             pass
     return match_ids
 
-def get_files(path='/home/user/', pattern='', recursive=False):
-    """ Returns all files in path matching the pattern. """
-    files = []
-    realpath = os.path.realpath(path)
-    with os.scandir(realpath) as fileobject_iterator:
-        for fileobject in fileobject_iterator:
-            if not os.path.islink(fileobject.path):
-                if fileobject.is_file() and pattern in fileobject.name:  # match pattern
-                    files.append(fileobject.path)
-                elif recursive and fileobject.is_dir():
-                    files.append( \
-                        get_files(path=fileobject.path, pattern=pattern, recursive=recursive))
-    return flatten(files)
-
-def get_folders(path='/home/user/', pattern='', exclusions='', recursive=False):
-    """ Returns all folders in path matching the pattern, but excluding the antipattern. """
-    folders = []
-    realpath = os.path.realpath(path)
-    with os.scandir(realpath) as fileobject_iterator:
-        for fileobject in fileobject_iterator:
-            if not os.path.islink(fileobject.path):
-                if fileobject.is_dir() and \
-                bool(True not in [(antipattern in fileobject.name) for antipattern in exclusions]):
-                    folders.append(fileobject.path)
-                    if recursive:  # traverse into subfolder
-                        folders.append(get_folders(path=fileobject.path, pattern=pattern, \
-                                                   exclusions=exclusions, recursive=recursive))
-    return flatten(folders)
+def get_cell_position(values=None, columns=None):
+    """ Returns the image, cell ID, and X/Y position of a cell from its line values. """
+    image = values[columns[0]] if columns[0] is not None else ""
+    return (image, values[columns[1]], float(values[columns[2]]), float(values[columns[3]]))
+
+def get_cell_positions(path='/home/user/', tolerance=1.0):
+    """ Returns the cells of a file as spatial hashes by image, which map grid bins
+        with the size of `tolerance` to lists of (line index, cell ID, X, Y) tuples.
+        Returns `None`, if the file has no cell position columns. """
+    cells = {}  # spatial hashes by image
+    for index, line in enumerate(iter_lines(path)):
+        values = line.rstrip("\r\n").split("\t")
+        if index == 0:  # header
+            columns = get_position_columns(values)
+            if columns is None:
+                return None
+            continue
+        try:
+            image, cell_id, pos_x, pos_y = get_cell_position(values, columns)
+        except (IndexError, ValueError):
+            continue  # empty line or invalid position
+        grid_bin = (int(pos_x // tolerance), int(pos_y // tolerance))
+        cells.setdefault(image, {}).setdefault(grid_bin, []).append((index, cell_id,
+                                                                      pos_x, pos_y))
+    return cells
 
 def get_line_counts(path='/home/user/'):
     """ Returns the number of lines counted in a file. """
@@ -133,6 +139,38 @@ def get_line_counts(path='/home/user/'):
     count += 1
     return count
 
+def get_position_columns(labels=None):
+    """ Returns the column indices of the image name, cell ID, and X/Y position from
+        the header labels or `None`, if the position columns are missing. """
+    columns = [labels.index(label) if label in labels else None for label in POSITION_LABELS]
+    if columns[2] is None or columns[3] is None:
+        return None
+    if columns[1] is None:  # inForm default
+        columns[1] = 4
+    return columns
+
+def match_cell(cells=None, matched=None, cell=None, tolerance=1.0):
+    """ Returns the closest unmatched reference cell within the tolerance of a cell
+        as (line index, cell ID, X, Y) tuple, preferring reference cells with the
+        same cell ID. Returns `None`, if no reference cell is within the tolerance. """
+    image, cell_id, pos_x, pos_y = cell
+    grid = cells.get(image, {})
+    bin_x, bin_y = int(pos_x // tolerance), int(pos_y // tolerance)
+    best = None  # ((different ID, squared distance), reference cell)
+    for near_x in (bin_x - 1, bin_x, bin_x + 1):  # neighboring bins
+        for near_y in (bin_y - 1, bin_y, bin_y + 1):
+            for ref_cell in grid.get((near_x, near_y), ()):
+                ref_index, ref_id, ref_x, ref_y = ref_cell
+                if ref_index in matched:
+                    continue
+                distance = (ref_x - pos_x) ** 2 + (ref_y - pos_y) ** 2
+                if distance > tolerance ** 2:
+                    continue
+                rank = (ref_id != cell_id, distance)
+                if best is None or rank < best[0]:
+                    best = (rank, ref_cell)
+    return best[1] if best else None
+
 def println(string=""):
     """ Prints a string and forces immediate output. """
     print(string)
@@ -141,47 +179,105 @@ def println(string=""):
 def sync_cell_ids(in_path='/home/user/', match_ids=None, out_path='/home/user/'):
     """ Synchronizes the lines of a file based on the list of cell IDs from a reference
         and writes the synchronized content to a file. Returns the number of removed lines. """
-    with open(in_path, 'r') as in_file:  # non-synchronized file
-        with open(out_path, 'w') as out_file:  # synchronized file
-            offset = 0  #  offset to synced file, if lines were skipped
-            for index, line in enumerate(in_file):
-                try:
-                    check_id = line.split("\t")[4]
-                except IndexError:
-                    pass  # empty line or list too short
-                finally:
-                    if check_id == match_ids[index - offset]:
-                        out_file.write(line)
-                    else:
-                        offset += 1
+    with WriterPool(workers=1) as writers:  # synchronized file
+        out_lines = []
+        offset = 0  #  offset to synced file, if lines were skipped
+        for index, line in enumerate(iter_lines(in_path)):  # non-synchronized file
+            try:
+                check_id = line.split("\t")[4]
+            except IndexError:
+                pass  # empty line or list too short
+            finally:
+                if check_id == match_ids[index - offset]:
+                    out_lines.append(line)
+                    if len(out_lines) >= CHUNK_LINES:  # write in chunks
+                        writers.write(out_path, out_lines, mode='w')
+                        out_lines = []
+                else:
+                    offset += 1
+        writers.write(out_path, out_lines, mode='w', close=True)
     return offset
 
+def sync_cell_positions(in_path='/home/user/', ref_path='/home/user/',
+                        out_path='/home/user/', tolerance=1.0):
+    """ Synchronizes the lines of a file with a reference by pairing cells per image
+        by their cell ID and X/Y position within a tolerance, so that renumbered
+        cells are matched, and writes the paired lines in the order of the reference.
+        Renumbered cells are written with the cell ID of their reference cell.
+        Returns the number of removed lines or `None`, if positions are missing. """
+    cells = get_cell_positions(path=ref_path, tolerance=tolerance)
+    if cells is None:
+        return None
+    paired_lines = {}  # lines by reference line index
+    removed = 0
+    for index, line in enumerate(iter_lines(in_path)):  # non-synchronized file
+        values = line.rstrip("\r\n").split("\t")
+        if index == 0:  # header
+            columns = get_position_columns(values)
+            if columns is None:
+                return None
+            paired_lines[0] = line
+            continue
+        try:
+            cell = get_cell_position(values, columns)
+        except (IndexError, ValueError):
+            ref_cell = None  # empty line or invalid position
+        else:
+            ref_cell = match_cell(cells, paired_lines, cell, tolerance)
+        if ref_cell is None:
+            removed += 1
+            continue
+        if ref_cell[1] != cell[1]:  # renumbered cell, use reference cell ID
+            values[columns[1]] = ref_cell[1]
+            line = "\t".join(values) + line[len(line.rstrip("\r\n")):]
+        paired_lines[ref_cell[0]] = line
+    with WriterPool(workers=1) as writers:  # synchronized file
+        out_lines = [paired_lines[ref_index] for ref_index in sorted(paired_lines)]
+        for start in range(0, len(out_lines), CHUNK_LINES):  # write in chunks
+            writers.write(out_path, out_lines[start:start + CHUNK_LINES], mode='w')
+        writers.write(out_path, [], mode='w', close=True)
+    return removed
+
 #  constants & variables
 
 BATCHES = []
 CHANNELS = []
 EXPORT_FOLDER = r".\export"
+FAST_HASH = False  # also fingerprint files by sampled content
 FILE_TARGET = "_cell_seg_data.txt"  # data and summaries required for consolidation
 FOLDER_EXCLUSION = ["Stroma", "Tumor"]  # exclude folders with scoring information
+INCREMENTAL = True  # count lines only in new or changed files
+MATCH_POSITIONS = False  # pair cells by cell ID and position, for renumbered cells
+POSITION_LABELS = ["Sample Name", "Cell ID", "Cell X Position", "Cell Y Position"]
+POSITION_TOLERANCE = 0.5  # maximum distance of paired cells, in units of the file
 VERSION = "phenoptrreports_consolidation_synchronizer 1.1 (2021-04-28)"
 
 #  main program
 
+METRICS = RunMetrics(VERSION)
+MANIFEST = None
+if INCREMENTAL:
+    MANIFEST = RunManifest(os.path.join(EXPORT_FOLDER, get_manifest_file(VERSION)), FAST_HASH,
+                           settings={"MATCH_POSITIONS": MATCH_POSITIONS,
+                                     "POSITION_TOLERANCE": POSITION_TOLERANCE,
+                                     "VERSION": VERSION})
 println(VERSION)
 println(os.linesep)
 println("Retrieving folder lists (1/6):")
 println("------------------------------")
 println("EXPORT: \"" + EXPORT_FOLDER.rsplit('\\', 1)[1] + "\"")
+METRICS.start_phase("folders")
 
-for channel_folder in get_folders(EXPORT_FOLDER, '', FOLDER_EXCLUSION):
-    println("\tCHANNEL: \"" + channel_folder + "\"")
+for channel_folder in get_folders(os.path.realpath(EXPORT_FOLDER),
+                                  exclude=["*" + name + "*" for name in FOLDER_EXCLUSION]):
+    METRICS.log("\tCHANNEL: \"" + channel_folder + "\"")
     channel = channel_folder.rsplit('\\', 1)[1]
     if channel not in CHANNELS:  # unique names only
         CHANNELS.append(channel)
 
     for batch_folder in get_folders(channel_folder):
         batch = batch_folder.rsplit('\\', 1)[1]
-        println("\t\tBATCH: \"" + batch + "\"")
+        METRICS.log("\t\tBATCH: \"" + batch + "\"")
         if batch not in BATCHES:  # unique names only
             BATCHES.append(batch)
 
@@ -197,18 +293,21 @@ println("Counting matching file names (2/6):")
 println("---------------------------------")
 println("FILE: \"*" + FILE_TARGET + "*\"")
 MATCHING_NAMES = 0
+METRICS.start_phase("names")
 BATCH_FILE_COUNTS = {}  # file counts by batch
 CHANNEL_COUNT = len(CHANNELS)
 
 for batch in BATCHES:
-    println("\tBATCH: \"" + batch + "\"")
+    METRICS.log("\tBATCH: \"" + batch + "\"")
 
     FILE_COUNTS = {}  # file counts by channel
     for channel in CHANNELS:
-        println("\t\tCHANNEL: \"" + channel + "\"")
+        METRICS.log("\t\tCHANNEL: \"" + channel + "\"")
 
-        for match in get_files(os.path.join(EXPORT_FOLDER, channel, batch), FILE_TARGET):
+        for match in get_files(os.path.realpath(os.path.join(EXPORT_FOLDER, channel, batch)),
+                               include=["*" + FILE_TARGET + "*"]):
             file = match.rsplit('\\', 1)[1]
+            METRICS.count(files=1)
             if file in FILE_COUNTS:
                 FILE_COUNTS[file] += 1  # increment key value
             else:  # file not in list
@@ -230,13 +329,14 @@ println("Moving unmatched files to folder (3/6):")
 println("---------------------------------------")
 UNMATCHED_FILES = 0
 FOLDER_TARGET = "unmatched"
+METRICS.start_phase("unmatched")
 println("FOLDER: \"" + FOLDER_TARGET + "\"")
 
 for channel in CHANNELS:
-    println("\tCHANNEL: \"" + channel + "\"")
+    METRICS.log("\tCHANNEL: \"" + channel + "\"")
 
     for batch in BATCHES:
-        println("\t\tBATCH: \"" + batch + "\"")
+        METRICS.log("\t\tBATCH: \"" + batch + "\"")
 
         for file, counts in BATCH_FILE_COUNTS[batch].items():
             if counts < CHANNEL_COUNT:  # file does not exist in all batch folders
@@ -251,8 +351,9 @@ for channel in CHANNELS:
                     except FileNotFoundError:
                         pass
                     else:  # success
-                        print("\t\t\tFILE: \"" + os.path.join(mat_path, file) + "\"")
+                        METRICS.log("\t\t\tFILE: \"" + os.path.join(mat_path, file) + "\"")
                         UNMATCHED_FILES += 1  # only count moved files
+                        METRICS.count(files=1)
 
 println("UNMATCHED FILES: " + str(UNMATCHED_FILES) + ".")
 println(os.linesep)
@@ -264,22 +365,31 @@ println("Checking line counts in matching files (4/6):")
 println("---------------------------------------------")
 println("FILE: \"*" + FILE_TARGET + "*\"")
 CHECKED_FILES = 0
+METRICS.start_phase("line counts")
 BATCH_FILE_MINS = {}  # file line (minimum) counts by batch
 BATCH_CHANNEL_FILE_LINES = {}  # file line (actual) counts by batch and channel
+CHECKED_PATHS = []
 
 for batch in BATCHES:
-    println("\tBATCH: \"" + batch + "\"")
+    METRICS.log("\tBATCH: \"" + batch + "\"")
 
     FILE_MINS = {}  # file line (minimum) count by batch
     CHANNEL_FILE_LINES = {}  # file line (absolute) count by channel
     for channel in CHANNELS:
-        println("\t\tCHANNEL: \"" + channel + "\"")
+        METRICS.log("\t\tCHANNEL: \"" + channel + "\"")
 
         FILE_LINES = {}  # file line (absolute) count within channel
-        for match in get_files(os.path.join(EXPORT_FOLDER, channel, batch), FILE_TARGET):
+        for match in get_files(os.path.realpath(os.path.join(EXPORT_FOLDER, channel, batch)),
+                               include=["*" + FILE_TARGET + "*"]):
             LINE_COUNT = 0
             file = match.rsplit('\\', 1)[1]
-            LINE_COUNT = get_line_counts(match)
+            LINE_COUNT = MANIFEST.get_data(match) if MANIFEST else None
+            if LINE_COUNT is None:  # new or changed file
+                LINE_COUNT = get_line_counts(match)
+                METRICS.count_read(match, rows=LINE_COUNT)
+                if MANIFEST:
+                    MANIFEST.record(match, data=LINE_COUNT)
+            CHECKED_PATHS.append(match)
             FILE_LINES[file] = LINE_COUNT
             if file in FILE_MINS:
                 FILE_MINS[file] = LINE_COUNT if LINE_COUNT < FILE_MINS[file] else FILE_MINS[file]
@@ -292,6 +402,10 @@ for batch in BATCHES:
     BATCH_FILE_MINS[batch] = FILE_MINS
     BATCH_CHANNEL_FILE_LINES[batch] = CHANNEL_FILE_LINES
 
+if MANIFEST:  # forget moved or removed files
+    MANIFEST.prune(CHECKED_PATHS)
+    MANIFEST.save()
+
 print("CHECKED FILES: " + str(CHECKED_FILES) + ".")
 println(os.linesep)
 
@@ -302,13 +416,14 @@ println("Moving matching files with unbalanced lines to folder (5/6):")
 println("------------------------------------------------------------")
 UNBALANCED_FILES = 0
 FOLDER_TARGET = "unbalanced"
+METRICS.start_phase("unbalanced")
 println("FOLDER: \"" + FOLDER_TARGET + "\"")
 
 for batch in BATCHES:
-    println("\tBATCH: \"" + batch + "\"")
+    METRICS.log("\tBATCH: \"" + batch + "\"")
 
     for channel in CHANNELS:
-        println("\t\tCHANNEL: \"" + channel + "\"")
+        METRICS.log("\t\tCHANNEL: \"" + channel + "\"")
 
         for file, lines in BATCH_CHANNEL_FILE_LINES[batch][channel].items():
             try:  # avoid exception, when unmatched files are not removed (test run)
@@ -325,8 +440,9 @@ for batch in BATCHES:
                 except FileNotFoundError:
                     pass
                 else:
-                    print("\t\t\tFILE: \"" + os.path.join(bal_path, file) + "\"")
+                    METRICS.log("\t\t\tFILE: \"" + os.path.join(bal_path, file) + "\"")
                     UNBALANCED_FILES += 1  # only count moved files
+                    METRICS.count(files=1)
 
 println("UNBALANCED FILES: " + str(UNBALANCED_FILES) + ".")
 println(os.linesep)
@@ -337,13 +453,14 @@ println(os.linesep)
 println("Removing unbalanced lines in matching files (6/6):")
 println("--------------------------------------------------")
 UNBALANCED_LINES = 0
+METRICS.start_phase("synchronize")
 println("FOLDER: \"" + FOLDER_TARGET + "\"")
 
 for batch in BATCHES:
-    println("\tBATCH: \"" + batch + "\"")
+    METRICS.log("\tBATCH: \"" + batch + "\"")
 
     for channel in CHANNELS:
-        println("\t\tCHANNEL: \"" + channel + "\"")
+        METRICS.log("\t\tCHANNEL: \"" + channel + "\"")
 
         # loop: get all files with unbalanced lines to fix
         for unb_file, unb_lines in BATCH_CHANNEL_FILE_LINES[batch][channel].items():
@@ -358,28 +475,41 @@ for batch in BATCHES:
 
                 # loop: get the first reference file with paired lines to synchronize with
                 for REF_CHANNEL, ref_file_lines in BATCH_CHANNEL_FILE_LINES[batch].items():
-
-                    for REF_FILE, REF_LINES in ref_file_lines.items():
-                        if REF_LINES == bal_lines:
-                            break  # break out of the inner reference loop
-
-                    if REF_LINES == bal_lines:  # redundant, but required to force second break
-                        break  # break out of the outer reference loop
+                    REF_FILE = unb_file  # same region in another channel
+                    REF_LINES = ref_file_lines.get(REF_FILE, 0)
+                    if REF_LINES == bal_lines:
+                        break  # break out of the reference loop
 
                 # target for balanced file
                 bal_path = os.path.join(EXPORT_FOLDER, channel, batch, unb_file)
                 # reference for balanced file
                 ref_path = os.path.join(EXPORT_FOLDER, REF_CHANNEL, batch, REF_FILE)
-                # cell IDs to compare from reference
-                cell_ids = get_cell_ids(path=ref_path, length=unb_lines)
                 # source for unbalanced file
                 unb_path = os.path.join(EXPORT_FOLDER, channel, batch, FOLDER_TARGET, unb_file)
                 # remove unbalanced lines and write balanced file
-                UNBALANCED_LINES += sync_cell_ids(in_path=unb_path, match_ids=cell_ids,
+                REMOVED_LINES = None
+                if MATCH_POSITIONS:  # pair cells by cell IDs and positions
+                    REMOVED_LINES = sync_cell_positions(in_path=unb_path, ref_path=ref_path,
+                                                        out_path=bal_path,
+                                                        tolerance=POSITION_TOLERANCE)
+                if REMOVED_LINES is None:  # pair cells by cell IDs in order
+                    # cell IDs to compare from reference
+                    cell_ids = get_cell_ids(path=ref_path, length=unb_lines)
+                    REMOVED_LINES = sync_cell_ids(in_path=unb_path, match_ids=cell_ids,
                                                   out_path=bal_path)
-                print("\t\t\tFILE: \"" + bal_path + "\"")
+                UNBALANCED_LINES += REMOVED_LINES
+                if MANIFEST:  # balanced file replaces the unbalanced file
+                    MANIFEST.record(bal_path, data=unb_lines - REMOVED_LINES)
+                METRICS.count_read(ref_path, rows=unb_lines)
+                METRICS.count_read(unb_path, rows=unb_lines)
+                METRICS.count_written(bal_path)
+                METRICS.log("\t\t\tFILE: \"" + bal_path + "\"")
+
+if MANIFEST:
+    MANIFEST.save()
 
 println("UNBALANCED LINES: " + str(UNBALANCED_LINES) + ".")
+METRICS.finish()
 println(os.linesep)
 
 WAIT = input("Press ENTER to exit this program.")
@@ -34,44 +34,67 @@ Unmerged files can either be used to convert sets of samples/MSIs
 into flow cytometry standard files or to re-merge and consolidate
 smaller data subsets.
 The header lines are preserved for each of the unmerged files.
+Optionally, each sample can be downsampled to a fixed number of lines,
+see the "reservoir_sampling" module for details.
+Run metrics are recorded with the "run_metrics" module, use the "--quiet"
+option to skip progress messages for large data sets.
+Merge files are only split again if they changed since the previous run,
+see the "run_manifest" module for details.
+Merge files with a valid cache are split by copying the lines of each
+sample directly from the merge file, see the "cell_table_cache" module.
+Optionally, cell counts and marker means per sample and phenotype are
+summarized while splitting, see the "summary_table" module for details.
+Merge files are read ahead and split files are written in the background
+in chunks of lines, see the "io_pipeline" module for details.
+Optionally, merge files with contiguous samples are split by copying the
+byte range of each sample, found by probing only lines near the sample
+boundaries, without reading the lines in between ("range copy").
 """
 
 #  imports
 
+import locale
+import mmap
 import os
 import sys
 
+from cell_table_cache import build_cache, open_cache
+from file_discovery import get_files
+from io_pipeline import CHUNK_LINES, WriterPool, iter_lines
+from reservoir_sampling import SAMPLING_COLUMN, Reservoir, append_column, get_sample
+from run_manifest import RunManifest, get_manifest_file
+from run_metrics import RunMetrics
+from summary_table import SummaryTable
+
 #  functions
 
-def export_data(out_path='/home/user', out_data=None):
-    """ Writes data from an array to a file. """
-    with open(out_path, 'w') as out_file:
-        for out_line in out_data:
-            out_file.write(out_line)
-
-def flatten(deep_list=None):
-    """ Returns a flattened list with elements from (deep) lists or tuples """
-    flat_list = []
-    for item in deep_list:
-        if isinstance(item, (list, tuple)):
-            flat_list.extend(flatten(item))
-        else:
-            flat_list.append(item)
-    return flat_list
-
-def get_files(path='/home/user/', pattern='', recursive=False):
-    """ Returns all files in path matching the pattern. """
-    files = []
-    realpath = os.path.realpath(path)
-    with os.scandir(realpath) as fileobject_iterator:
-        for fileobject in fileobject_iterator:
-            if not os.path.islink(fileobject.path):
-                if fileobject.is_file() and pattern in fileobject.name:  # match pattern
-                    files.append(fileobject.path)
-                elif recursive and fileobject.is_dir():
-                    files.append( \
-                        get_files(path=fileobject.path, pattern=pattern, recursive=recursive))
-    return flatten(files)
+def copy_range(in_file=None, out_file=None, start=0, stop=0, data=None):
+    """ Appends a byte range of the input file to the output file, copied by the
+        kernel if supported or from the memory-mapped `data` of the input file. """
+    out_file.flush()  # header first
+    if hasattr(os, "copy_file_range"):  # Linux only
+        try:
+            while start < stop:
+                copied = os.copy_file_range(in_file.fileno(), out_file.fileno(),
+                                            stop - start, start)
+                if not copied:
+                    break
+                start += copied
+        except OSError:  # not supported by the file system
+            pass
+    out_file.write(memoryview(data)[start:stop])
+
+def export_data(out_path='/home/user', out_data=None, writers=None):
+    """ Writes data from an array to a file in the background, the file is
+        opened by the first chunk of a sample and closed by its last chunk. """
+    writers.write(out_path, out_data, mode='w', close=True)
+
+def get_line_start(data=None, position=0):
+    """ Returns the start of the first line at or after a byte position. """
+    if position <= 0 or data[position - 1:position] == b"\n":
+        return position
+    line_end = data.find(b"\n", position)
+    return len(data) if line_end < 0 else line_end + 1
 
 def get_name_index(path='', delimiter='', name=None):
     """ Returns the column index with the sample/MSI name. """
@@ -88,54 +111,212 @@ def get_name_index(path='', delimiter='', name=None):
 
     return float("nan")  # no index found
 
+def get_range_end(data=None, start=0, get_key=None):
+    """ Returns the end of the byte range with the same key as the line at `start`,
+        probing single lines by galloping and bisection - lines with the same key
+        must be contiguous. """
+    key = get_key(start)
+    low, high, step = start, len(data), RANGE_STEP
+    while low + step < high:  # gallop to a line with a different key
+        probe = get_line_start(data, low + step)
+        if probe >= high:
+            break
+        if get_key(probe) != key:
+            high = probe
+            break
+        low = probe
+        step *= 2
+    while True:  # bisect: the line at `low` has the key, the line at `high` not
+        probe = get_line_start(data, (low + high) // 2)
+        if probe <= low:
+            probe = get_line_start(data, low + 1)
+        if probe >= high:  # next line after `low`
+            return high
+        if get_key(probe) == key:
+            low = probe
+        else:
+            high = probe
+
+def get_sample_name(line='', index=0, by_msi=False):
+    """ Returns the sample name of a data line, with or without MSI coordinates. """
+    sample_name = line.split("\t")[index].rsplit(sep=".", maxsplit=1)[0]
+    if not by_msi:  # ignore MSI coordinates
+        sample_name = sample_name.rsplit(sep="_", maxsplit=1)[0]
+    return sample_name
+
 def println(string=""):
     """ Prints a string and forces immediate output. """
     print(string)
     sys.stdout.flush()
 
-def unmerge_data(in_path='', index=0, by_msi=False, out_path=''):
+def unmerge_cache(cache=None, index=0, by_msi=False, out_path='', sample_size=0,
+                  summary=None):
+    """ Writes out the data of each sample from the cache of a merge file, the lines
+        are copied as-is from the merge file unless samples are downsampled.
+        Returns the number of data lines and the list of files written. """
+    name = os.path.splitext(os.path.basename(cache.in_path))[0]
+    METRICS.log("\tFOLDER: \"" + out_path + "\"")
+    if not os.path.exists(out_path):
+        os.mkdir(out_path)
+    METRICS.log("\t\tSAMPLES:")
+    out_paths = []
+    if summary:
+        summary.set_header(cache.get_header().decode(cache.encoding))
+    samples = cache.get_groups(lambda line: get_sample_name(line, index, by_msi))
+    with WriterPool() as writers:
+        for sample, start, stop in samples:
+            METRICS.log("\t\t\t\t\"" + sample + "\"")
+            if summary:
+                summary.add_rows(sample, cache, start, stop)
+            out_paths.append(out_path + os.path.sep + name + " - " + sample + ".txt")
+            if sample_size > 0:  # read kept lines only
+                reservoir = Reservoir(sample_size, SAMPLE_SEED, sample)
+                for row in range(start, stop):
+                    reservoir.add(row)
+                fraction = str(reservoir.get_fraction())
+                header = cache.get_header().decode(cache.encoding)
+                file_data = [append_column(header, SAMPLING_COLUMN, "\t")]
+                for row in reservoir.get_lines():
+                    file_data.append(append_column(cache.get_line(row), fraction, "\t"))
+                export_data(out_path=out_paths[-1], out_data=file_data, writers=writers)
+            else:  # copy lines
+                rows = [cache.get_header(), cache.get_rows(start, stop)]
+                writers.write(out_paths[-1], rows, mode='wb', close=True)
+    for out_file in out_paths:
+        METRICS.count_written(out_file)
+    return (cache.rows, out_paths)
+
+def unmerge_data(in_path='', index=0, by_msi=False, out_path='', sample_size=0,
+                 summary=None):
     """ Imports data from a text file and writes out all columns on a per-file basis
-        using the first column's data for labeling of individual export files. """
-    with open(in_path, 'r') as in_file:
+        using the first column's data for labeling of individual export files.
+        Samples are downsampled to `sample_size` lines, if `sample_size` is positive.
+        Lines are added to the `summary`, if given.
+        Returns the number of data lines read and the list of files written. """
+    cache = open_cache(in_path)
+    if not cache and BUILD_CACHE:
+        build_cache(in_path=in_path, key_label="Sample Name", encoding=None)
+        cache = open_cache(in_path)
+    if cache:
+        try:
+            return unmerge_cache(cache=cache, index=index, by_msi=by_msi,
+                                 out_path=out_path, sample_size=sample_size,
+                                 summary=summary)
+        finally:
+            cache.close()
+    if RANGE_COPY and sample_size <= 0 and not summary:  # no lines needed
+        return unmerge_ranges(in_path=in_path, index=index, by_msi=by_msi,
+                              out_path=out_path)
+    with WriterPool() as writers:
         name = os.path.splitext(os.path.basename(in_path))[0]
-        println("\tFOLDER: \"" + out_path + "\"")
+        METRICS.log("\tFOLDER: \"" + out_path + "\"")
         if not os.path.exists(out_path):
             os.mkdir(out_path)
-        println("\t\tSAMPLES:")
-        for in_index, in_line in enumerate(in_file):
+        METRICS.log("\t\tSAMPLES:")
+        out_paths = []
+        for in_index, in_line in enumerate(iter_lines(in_path)):
             if in_index == 0:  # header
                 file_data = []
                 header = in_line
+                if summary:
+                    summary.set_header(header)
+                if sample_size > 0:
+                    header = append_column(header, SAMPLING_COLUMN, "\t")
                 file_data.append(header)
                 current_sample = ""
                 previous_sample = ""
+                reservoir = None
             else:  # data
-                current_sample = in_line.split("\t")[index].rsplit(sep=".", maxsplit=1)[0]
-                if not by_msi:  # ignore MSI coordinates
-                    current_sample = current_sample.rsplit(sep="_", maxsplit=1)[0]
+                current_sample = get_sample_name(line=in_line, index=index, by_msi=by_msi)
                 if current_sample != previous_sample:  # sample name or MSI coordinates changed
-                    println("\t\t\t\t\"" + current_sample + "\"")
-                    if previous_sample:  # save collected data
-                        export_data(out_path=out_path + os.path.sep + name + \
-                                             " - " + previous_sample + ".txt", out_data=file_data)
+                    METRICS.log("\t\t\t\t\"" + current_sample + "\"")
+                    if previous_sample:  # save remaining data
+                        if reservoir:
+                            file_data.extend(get_sample(reservoir, "\t"))
+                        export_data(out_path=out_paths[-1], out_data=file_data,
+                                    writers=writers)
+                    out_paths.append(out_path + os.path.sep + name + \
+                                     " - " + current_sample + ".txt")
                     file_data = []  # prepare next sample
                     file_data.append(header)
+                    if sample_size > 0:
+                        reservoir = Reservoir(sample_size, SAMPLE_SEED, current_sample)
                 previous_sample = current_sample
-                file_data.append(in_line)
+                if summary:
+                    summary.add(current_sample, in_line)
+                if reservoir:
+                    reservoir.add(in_line)
+                else:
+                    file_data.append(in_line)
+                    if len(file_data) >= CHUNK_LINES:  # write in chunks
+                        writers.write(out_paths[-1], file_data, mode='w')
+                        file_data = []
         # write last sample before opening a new input file
-        export_data(out_path=out_path + os.path.sep + name + \
-                             " - " + previous_sample + ".txt", out_data=file_data)
+        if reservoir:
+            file_data.extend(get_sample(reservoir, "\t"))
+        if not previous_sample:  # header only
+            out_paths.append(out_path + os.path.sep + name + " - .txt")
+        export_data(out_path=out_paths[-1], out_data=file_data, writers=writers)
+    for out_file in out_paths:
+        METRICS.count_written(out_file)
+    return (in_index, out_paths)
+
+def unmerge_ranges(in_path='', index=0, by_msi=False, out_path=''):
+    """ Writes out the data of each sample by copying its byte range from the merge
+        file, only lines near the sample boundaries are read and decoded.
+        Returns zero data lines, since lines are not counted, and the list of
+        files written - run metrics report the bytes read instead. """
+    name = os.path.splitext(os.path.basename(in_path))[0]
+    METRICS.log("\tFOLDER: \"" + out_path + "\"")
+    if not os.path.exists(out_path):
+        os.mkdir(out_path)
+    METRICS.log("\t\tSAMPLES:")
+    out_paths = []
+    encoding = locale.getpreferredencoding(False)  # like `open()`
+    with open(in_path, 'rb') as in_file:
+        header = in_file.readline()
+        if in_file.read(1) == b"":  # no data lines, nothing to map
+            return (0, out_paths)
+        with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            def get_key(position=0):
+                line_end = data.find(b"\n", position)
+                line = data[position:line_end if line_end >= 0 else len(data)]
+                return get_sample_name(line.decode(encoding), index, by_msi)
+            start = len(header)
+            while start < len(data):
+                stop = get_range_end(data, start, get_key)
+                sample = get_key(start)
+                METRICS.log("\t\t\t\t\"" + sample + "\"")
+                out_paths.append(out_path + os.path.sep + name + " - " + sample + ".txt")
+                with open(out_paths[-1], 'wb') as out_file:
+                    out_file.write(header)
+                    copy_range(in_file, out_file, start, stop, data)
+                start = stop
+    for out_file in out_paths:
+        METRICS.count_written(out_file)
+    return (0, out_paths)
 
 #  constants & variables
 
+BUILD_CACHE = False  # cache merge files before splitting, for repeated splits
 EXPORT_FOLDER = r".\export"
+FAST_HASH = False  # also fingerprint merge files by sampled content
 FILE_TARGET = "Merge_cell_seg_data.txt"
 IMPORT_FOLDER = r".\import"
+INCREMENTAL = True  # split only new or changed merge files
+RANGE_COPY = False  # copy byte ranges of samples, requires contiguous samples
+RANGE_STEP = 65536  # bytes of the first probe when searching sample boundaries
+SAMPLE_SEED = 0  # fixed seed for reproducible downsampling
+SAMPLE_SIZE = 0  # lines per sample, downsample if positive
 SPLIT_BY_MSI = False  # split by name *and* MSI coordinates
+SUMMARIZE = False  # summarize cell counts and marker means while splitting
+SUMMARY_FILE = "summary_table.txt"
+SUMMARY_PATTERN = r" Mean\b"  # labels of the summarized columns
 VERSION = "phenoptrreports_mergefile_splitter 1.0 (2021-10-12)"
 
 #  main program
 
+METRICS = RunMetrics(VERSION)
 println(VERSION)
 println(os.linesep)
 println("UNMERGING files in folder:")
@@ -146,13 +327,56 @@ FILE_COUNT = 0
 if not os.path.exists(EXPORT_FOLDER):
     os.mkdir(EXPORT_FOLDER)
 
-for file in get_files(IMPORT_FOLDER, FILE_TARGET):
-    println("\tNAME: \"" + file + "\"")
+MANIFEST = None
+if INCREMENTAL:
+    MANIFEST = RunManifest(os.path.join(EXPORT_FOLDER, get_manifest_file(VERSION)), FAST_HASH,
+                           settings={"RANGE_COPY": RANGE_COPY, "SAMPLE_SEED": SAMPLE_SEED,
+                                     "SAMPLE_SIZE": SAMPLE_SIZE,
+                                     "SPLIT_BY_MSI": SPLIT_BY_MSI,
+                                     "SUMMARY_PATTERN": SUMMARY_PATTERN,
+                                     "VERSION": VERSION})
+FILES = get_files(IMPORT_FOLDER, include=["*" + FILE_TARGET + "*"])
+if MANIFEST and MANIFEST.exists:
+    println("STALE OUTPUTS: " + str(MANIFEST.prune(FILES)))
+    MANIFEST.save()
+
+SUMMARY = None
+if SUMMARIZE:
+    SUMMARY = SummaryTable(SUMMARY_PATTERN, phenotype_label="Phenotype")
+
+METRICS.start_phase("unmerge")
+for file in FILES:
+    METRICS.log("\tNAME: \"" + file + "\"")
+    if MANIFEST and MANIFEST.is_current(file) and \
+       not (SUMMARY and MANIFEST.get_data(file) is None):  # summarized before
+        if SUMMARY:
+            SUMMARY.merge(MANIFEST.get_data(file))
+        METRICS.log("\tUNCHANGED")
+        continue
+    if MANIFEST:
+        MANIFEST.remove_outputs(file)
     name_index = get_name_index(path=file, delimiter='\t', name="Sample Name")
-    unmerge_data(in_path=file, index=name_index, by_msi=SPLIT_BY_MSI, out_path=EXPORT_FOLDER)
+    summary = None
+    if SUMMARY:
+        summary = SummaryTable(SUMMARY_PATTERN, phenotype_label="Phenotype")
+    LINES, OUTPUTS = unmerge_data(in_path=file, index=name_index, by_msi=SPLIT_BY_MSI,
+                                  out_path=EXPORT_FOLDER, sample_size=SAMPLE_SIZE,
+                                  summary=summary)
+    METRICS.count_read(file, rows=LINES)
+    if summary:
+        SUMMARY.merge(summary.get_data())
+    if MANIFEST:
+        MANIFEST.record(file, outputs=OUTPUTS,
+                        data=summary.get_data() if summary else None)
+        MANIFEST.save()
     FILE_COUNT += 1
 
+if SUMMARY:
+    SUMMARY.write(os.path.join(EXPORT_FOLDER, SUMMARY_FILE), group_label="Sample Name")
+    METRICS.count_written(os.path.join(EXPORT_FOLDER, SUMMARY_FILE))
+
 print("UNMERGED FILES: " + str(FILE_COUNT) + ".")
+METRICS.finish()
 println(os.linesep)
 
 
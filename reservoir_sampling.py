@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      reservoir_sampling
+Summary:    Downsample streams of lines to a fixed number of lines
+            with a uniform and reproducible random selection
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+This module is used by the splitter scripts to downsample samples or
+images with millions of cells while streaming through the merge files.
+Each reservoir keeps at most `size` lines in memory, regardless of the
+number of lines added, and skips ahead between replacements (Li's
+"Algorithm L"), so only a few random numbers are drawn per sample.
+Reservoirs are seeded with a fixed seed and the name of their sample,
+so the selection does not depend on the order of samples or files.
+The sampled lines are returned in their original order and carry the
+sampling fraction in an additional column, so that cell counts can be
+scaled back to the original sample size.
+"""
+
+#  imports
+
+import math
+import random
+
+#  classes
+
+
+class Reservoir:
+    """Keeps a uniform random sample of fixed size from a stream of lines.
+
+    Keyword arguments:
+    size -- the maximum number of lines to keep (default "0")
+    seed -- the seed for the random number generator (default "0")
+    name -- the name of the sample, combined with the seed (default "")
+    """
+
+    def __init__(self, size=0, seed=0, name=""):
+        self.size = size
+        self.count = 0  # lines added
+        self.lines = []  # (index, line) tuples
+        self.random = random.Random(str(seed) + ":" + name)
+        self.weight = 1.0
+        self.next = size - 1  # index of the next line to keep
+
+    def add(self, line=""):
+        """Add a line to the stream and keep it with the required probability."""
+        if self.count < self.size:
+            self.lines.append((self.count, line))
+            if self.count == self.size - 1:  # reservoir full
+                self.skip()
+        elif self.count == self.next:
+            self.lines[self.random.randrange(self.size)] = (self.count, line)
+            self.skip()
+        self.count += 1
+
+    def get_fraction(self):
+        """Return the fraction of lines kept from the stream."""
+        return len(self.lines) / self.count if self.count else 1.0
+
+    def get_lines(self):
+        """Return the lines kept from the stream in their original order."""
+        return [line for _index, line in sorted(self.lines, key=lambda item: item[0])]
+
+    def get_uniform(self):
+        """Return a random number from the open interval (0, 1)."""
+        number = self.random.random()
+        while not number:
+            number = self.random.random()
+        return number
+
+    def skip(self):
+        """Determine the index of the next line to keep."""
+        self.weight *= math.exp(math.log(self.get_uniform()) / self.size)
+        if self.weight < 1.0:
+            skipped = math.log(self.get_uniform()) / math.log1p(-self.weight)
+            self.next += int(skipped) + 1
+        else:  # rounding of very large sizes
+            self.next += 1
+
+
+#  functions
+
+
+def append_column(line="", value="", delimiter="\t"):
+    """Append a value as an additional column to a line of text.
+
+    Keyword arguments:
+    line -- the line of text, with or without line ending (default "")
+    value -- the value to append (default "")
+    delimiter -- the column delimiter of the line (default "\\t")
+    """
+    return line.rstrip("\r\n") + delimiter + value + "\n"
+
+
+def get_sample(reservoir=None, delimiter="\t"):
+    """Return the lines kept in a reservoir with their sampling fraction appended.
+
+    Keyword arguments:
+    reservoir -- the reservoir to read the lines from (default "None")
+    delimiter -- the column delimiter of the lines (default "\\t")
+    """
+    fraction = str(reservoir.get_fraction())
+    return [append_column(line, fraction, delimiter) for line in reservoir.get_lines()]
+
+
+#  constants & variables
+
+SAMPLING_COLUMN = "Sampling Fraction"  # label of the appended column
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      run_manifest
+Summary:    Keep track of processed input files and their output files
+            to process only new or changed input files in later runs
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+This module is used by the scripts to rerun incrementally: A manifest file
+records a fingerprint of each input file together with the output files
+that the input file produced and, optionally, data derived from it (e.g.
+line counts or positions). In later runs, input files with an unchanged
+fingerprint are skipped, the outputs of changed input files are removed
+before the input files are processed again, and the outputs of input files
+that no longer exist are removed as well.
+The fingerprint consists of the file size and modification time. With the
+optional fast hash, a hash of the first, middle, and last block of the file
+is added, so that changes are also detected if the size and modification
+time are preserved (e.g. by restoring a backup). The hash is added to the
+modification time and does not replace it, since edits outside of the
+hashed blocks would be missed otherwise. Paths are stored relative to the
+manifest file, so that the manifest remains valid when a study folder is
+moved.
+Each entry also records a hash of the settings that affect the outputs
+(e.g. the sample size), so that all input files are processed again after
+a setting changed.
+"""
+
+#  imports
+
+import hashlib
+import json
+import os
+
+#  classes
+
+
+class RunManifest:
+    """Records the fingerprints and outputs of input files in a manifest file.
+
+    Keyword arguments:
+    path -- the path to the manifest file (default "")
+    fast_hash -- add a hash of three blocks to the fingerprints (default "False")
+    settings -- the dictionary of settings that affect the outputs (default "None")
+    """
+
+    def __init__(self, path="", fast_hash=False, settings=None):
+        self.path = os.path.abspath(path)
+        self.folder = os.path.dirname(self.path)
+        self.fast_hash = fast_hash
+        self.settings = get_settings_hash(settings)
+        self.fingerprints = {}  # computed during this run
+        self.inputs = {}
+        self.exists = os.path.isfile(self.path)
+        if self.exists:
+            with open(self.path, "r", encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.inputs = manifest["inputs"]
+
+    def get_data(self, in_path=""):
+        """Return the recorded data of an unchanged input file or `None`."""
+        entry = self.get_entry(in_path)
+        return None if entry is None else entry["data"]
+
+    def get_entry(self, in_path=""):
+        """Return the entry of an input file, if the file and the settings are
+        unchanged since it was recorded, else `None`."""
+        entry = self.inputs.get(self.get_key(in_path))
+        if (
+            entry is None
+            or entry.get("settings") != self.settings
+            or entry["fingerprint"] != self.get_fingerprint(in_path)
+        ):
+            return None
+        return entry
+
+    def get_fingerprint(self, in_path=""):
+        """Return the fingerprint of an input file as a list."""
+        key = self.get_key(in_path)
+        if key not in self.fingerprints:
+            stat = os.stat(in_path)
+            fingerprint = [stat.st_size, stat.st_mtime_ns]
+            if self.fast_hash:
+                fingerprint.append(get_fast_hash(in_path, stat.st_size))
+            self.fingerprints[key] = fingerprint
+        return self.fingerprints[key]
+
+    def get_outputs(self, in_path=""):
+        """Return the absolute paths of the recorded outputs of an input file."""
+        entry = self.inputs.get(self.get_key(in_path))
+        return [] if entry is None else [self.get_path(key) for key in entry["outputs"]]
+
+    def get_key(self, path=""):
+        """Return the path of a file relative to the manifest file."""
+        try:
+            return os.path.relpath(os.path.abspath(path), self.folder)
+        except ValueError:  # different drives
+            return os.path.abspath(path)
+
+    def get_path(self, key=""):
+        """Return the absolute path of a file from its key."""
+        return os.path.normpath(os.path.join(self.folder, key))
+
+    def is_current(self, in_path=""):
+        """Return whether an input file and the settings are unchanged and all its
+        outputs exist."""
+        entry = self.get_entry(in_path)
+        if entry is None:
+            return False
+        return all(os.path.exists(self.get_path(key)) for key in entry["outputs"])
+
+    def prune(self, in_paths=None):
+        """Forget input files that are not in the list of paths, remove their
+        outputs, and return the number of outputs removed."""
+        keys = {self.get_key(in_path) for in_path in in_paths}
+        removed = 0
+        for key in [key for key in self.inputs if key not in keys]:
+            removed += len(self.remove_outputs(self.get_path(key)))
+            del self.inputs[key]
+        return removed
+
+    def record(self, in_path="", outputs=(), data=None):
+        """Record the current fingerprint, outputs, and data of an input file."""
+        self.fingerprints.pop(self.get_key(in_path), None)  # file might have changed
+        self.inputs[self.get_key(in_path)] = {
+            "fingerprint": self.get_fingerprint(in_path),
+            "settings": self.settings,
+            "outputs": sorted(self.get_key(out_path) for out_path in outputs),
+            "data": data,
+        }
+
+    def remove_outputs(self, in_path=""):
+        """Remove the recorded outputs of an input file and return their paths."""
+        entry = self.inputs.get(self.get_key(in_path))
+        removed = []
+        if entry is None:
+            return removed
+        for key in entry["outputs"]:
+            out_path = self.get_path(key)
+            if os.path.normcase(out_path) == os.path.normcase(os.path.abspath(in_path)):
+                continue  # updated in place
+            try:
+                os.remove(out_path)
+            except FileNotFoundError:
+                continue
+            removed.append(out_path)
+        entry["outputs"] = []
+        return removed
+
+    def save(self):
+        """Write the manifest file, replacing the previous version atomically."""
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(
+                {"version": MANIFEST_VERSION, "inputs": self.inputs},
+                manifest_file,
+                indent=1,
+                sort_keys=True,
+            )
+        os.replace(temporary_path, self.path)
+        self.exists = True
+
+
+#  functions
+
+
+def get_fast_hash(path="", size=0):
+    """Return a hash of the first, middle, and last block of a file.
+
+    Keyword arguments:
+    path -- the path to the file (default "")
+    size -- the size of the file in bytes (default "0")
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as in_file:
+        if size <= 3 * HASH_BLOCK:  # small file, hash completely
+            digest.update(in_file.read())
+        else:
+            for offset in (0, (size - HASH_BLOCK) // 2, size - HASH_BLOCK):
+                in_file.seek(offset)
+                digest.update(in_file.read(HASH_BLOCK))
+    return digest.hexdigest()
+
+
+def get_manifest_file(version=""):
+    """Return the name of the manifest file of a script, so that scripts writing
+    into the same folder do not remove each other's outputs.
+
+    Keyword arguments:
+    version -- the version string of the script, starting with its name (default "")
+    """
+    return MANIFEST_FILE.format(version.split(" ", 1)[0])
+
+
+def get_settings_hash(settings=None):
+    """Return a hash of the settings that affect the outputs.
+
+    Keyword arguments:
+    settings -- the dictionary of settings, values are compared as text (default "None")
+    """
+    text = json.dumps(settings or {}, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+#  constants & variables
+
+HASH_BLOCK = 1048576  # bytes hashed per block
+MANIFEST_FILE = "run_manifest_{}.json"  # name of the manifest file by script
+MANIFEST_VERSION = 1
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      run_metrics
+Summary:    Record wall times, data volumes, and memory usage of script runs
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+This module is used by the scripts to measure their runs phase by phase:
+Each phase records its wall time, the number of rows and files processed,
+and the number of bytes read and written. At the end of a run, a single
+JSON record with all phases, their throughput, and the peak memory of the
+process is appended to a metrics file ("run_metrics.jsonl"), one line per
+run, so that runs can be compared and parsed by other programs.
+The scripts accept the following command line options:
+    --quiet             do not print progress messages for individual items
+    --metrics PATH      append the metrics record to PATH ("" disables it)
+    --profile PATH      profile the run with "cProfile" and save the stats
+    --trace             print the start and end of each phase to stderr
+Progress messages are flushed immediately, which is slow on remote
+consoles - use "--quiet" for large data sets.
+"""
+
+#  imports
+
+import argparse
+import cProfile
+import ctypes
+import json
+import os
+import platform
+import sys
+import time
+
+#  classes
+
+
+class ProcessMemoryCounters(ctypes.Structure):
+    """The PROCESS_MEMORY_COUNTERS structure of the Windows API."""
+
+    _fields_ = [
+        ("cb", ctypes.c_ulong),
+        ("PageFaultCount", ctypes.c_ulong),
+        ("PeakWorkingSetSize", ctypes.c_size_t),
+        ("WorkingSetSize", ctypes.c_size_t),
+        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+        ("PagefileUsage", ctypes.c_size_t),
+        ("PeakPagefileUsage", ctypes.c_size_t),
+    ]
+
+
+class RunMetrics:
+    """Records the phases of a script run and writes them as a JSON record.
+
+    Keyword arguments:
+    name -- the name and version of the script (default "")
+    argv -- the command line arguments of the script (default "None")
+    """
+
+    def __init__(self, name="", argv=None):
+        self.options = get_options(sys.argv[1:] if argv is None else argv)
+        self.quiet = self.options.quiet
+        self.phase = None  # current phase
+        self.phase_name = ""
+        self.record = {
+            "name": name,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "phases": {},
+        }
+        self.start = time.perf_counter()
+        self.phase_start = self.start
+        self.profiler = None
+        if self.options.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def count(self, rows=0, files=0, bytes_read=0, bytes_written=0):
+        """Add the number of rows, files, and bytes processed to the current phase."""
+        if self.phase is None:
+            self.start_phase("main")
+        self.phase["rows"] += rows
+        self.phase["files"] += files
+        self.phase["bytes_read"] += bytes_read
+        self.phase["bytes_written"] += bytes_written
+
+    def count_read(self, path="", rows=0):
+        """Add a file and its size to the bytes read in the current phase."""
+        self.count(rows=rows, files=1, bytes_read=get_file_size(path))
+
+    def count_written(self, path="", rows=0):
+        """Add the size of a file to the bytes written in the current phase."""
+        self.count(rows=rows, bytes_written=get_file_size(path))
+
+    def finish(self):
+        """Stop the current phase and the profiler, write the metrics record,
+        and return the record as a dictionary."""
+        self.stop_phase()
+        seconds = time.perf_counter() - self.start
+        totals = {"seconds": seconds}
+        for key in ("rows", "files", "bytes_read", "bytes_written"):
+            totals[key] = sum(phase[key] for phase in self.record["phases"].values())
+        add_rates(totals)
+        self.record["total"] = totals
+        self.record["peak_memory_bytes"] = get_peak_memory()
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.options.profile)
+            self.record["profile"] = os.path.abspath(self.options.profile)
+        if self.options.metrics:
+            with open(self.options.metrics, "a", encoding="utf-8") as metrics_file:
+                metrics_file.write(json.dumps(self.record) + "\n")
+        print(
+            f"TIME: {seconds:.2f} s, ROWS: {totals['rows']}, FILES: "
+            f"{totals['files']}, PEAK MEMORY: "
+            f"{self.record['peak_memory_bytes'] / 1e6:.1f} MB",
+            flush=True,
+        )
+        return self.record
+
+    def log(self, string=""):
+        """Print a progress message for an individual item, unless quiet."""
+        if not self.quiet:
+            print(string, flush=True)
+
+    def start_phase(self, name=""):
+        """Stop the current phase and start (or continue) a named phase."""
+        self.stop_phase()
+        self.phase = self.record["phases"].setdefault(
+            name,
+            {
+                "seconds": 0.0,
+                "rows": 0,
+                "files": 0,
+                "bytes_read": 0,
+                "bytes_written": 0,
+            },
+        )
+        self.phase_name = name
+        self.phase_start = time.perf_counter()
+        if self.options.trace:
+            print(
+                f"[{self.phase_start - self.start:10.3f} s] START: {name}",
+                file=sys.stderr,
+                flush=True,
+            )
+
+    def stop_phase(self):
+        """Stop the current phase and add its wall time and throughput."""
+        if self.phase is None:
+            return
+        now = time.perf_counter()
+        self.phase["seconds"] += now - self.phase_start
+        add_rates(self.phase)
+        if self.options.trace:
+            print(
+                f"[{now - self.start:10.3f} s] STOP: {self.phase_name} "
+                f"({get_peak_memory() / 1e6:.1f} MB)",
+                file=sys.stderr,
+                flush=True,
+            )
+        self.phase = None
+
+
+#  functions
+
+
+def add_rates(metrics=None):
+    """Add the rows, files, and megabytes per second to a dictionary of metrics.
+
+    Keyword arguments:
+    metrics -- the dictionary with seconds, rows, files, and bytes (default "None")
+    """
+    seconds = metrics["seconds"]
+    for key, rate, scale in (
+        ("rows", "rows_per_second", 1),
+        ("files", "files_per_second", 1),
+        ("bytes_read", "megabytes_read_per_second", 1e6),
+        ("bytes_written", "megabytes_written_per_second", 1e6),
+    ):
+        metrics[rate] = metrics[key] / scale / seconds if seconds else 0.0
+
+
+def get_file_size(path=""):
+    """Return the size of a file in bytes or zero, if the file does not exist.
+
+    Keyword arguments:
+    path -- the path to the file (default "")
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def get_options(argv=None):
+    """Parse the command line options shared by all scripts, other options are ignored.
+
+    Keyword arguments:
+    argv -- the list of command line arguments (default "None")
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--metrics", default=METRICS_FILE)
+    parser.add_argument("--profile", default="")
+    parser.add_argument("--trace", action="store_true")
+    return parser.parse_known_args(argv)[0]
+
+
+def get_peak_memory():
+    """Return the peak resident memory of the current process in bytes."""
+    if sys.platform == "win32":
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(),
+            ctypes.byref(counters),
+            counters.cb,
+        )
+        return counters.PeakWorkingSetSize
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as status_file:
+            for line in status_file:  # high water mark, reset by `exec()`
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024  # kilobytes
+    except OSError:
+        pass
+    import resource  # not available on Windows
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes, kilobytes
+
+
+#  constants & variables
+
+METRICS_FILE = "run_metrics.jsonl"  # metrics records, one line per run
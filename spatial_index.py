@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      spatial_index
+Summary:    Index cell positions by phenotype to find nearest neighbors
+            and count cells within a radius
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+Please install the latest version of the "numpy" module with "conda"
+("conda install numpy") or "pip" ("pip install numpy").
+The index sorts the cells of each image into one uniform grid per phenotype,
+with the bin size chosen for about one cell per bin, so that a query only
+compares a cell with the cells in its neighboring bins - instead of all
+cells in the image ("phenoptr::find_nearest_distance", "count_within").
+Cell positions are only comparable within an image, so cells are grouped
+by their sample name (one image per MSI) and only compared with the cells
+of the same image, also if split files contain several images.
+Queries are vectorized over all query cells and their neighboring bins:
+Counts within a radius search a fixed square of bins, nearest neighbors
+are searched in rings of bins around each cell until no closer cell can
+be found. The query cell itself is never counted or returned.
+When run as a script, the cell positions and phenotypes of every split
+inForm file in the export folder are indexed, and the index is saved
+next to the file ("<split file>.spatial.npz") for later queries with
+`load_index()`. Files with a current index are skipped. Cells without
+positions are not indexed.
+"""
+
+#  imports
+
+import os
+
+import numpy as np
+
+from file_discovery import get_files
+
+#  classes
+
+
+class SpatialIndex:
+    """Finds neighboring cells by phenotype with one uniform grid per image and
+    phenotype.
+
+    Keyword arguments:
+    arrays -- the dictionary with the arrays of the index (default "None")
+    """
+
+    def __init__(self, arrays=None):
+        self.arrays = arrays
+        self.x = arrays["x"]
+        self.y = arrays["y"]
+        self.cell_ids = arrays["cell_ids"]
+        self.codes = arrays["codes"]  # phenotype of each cell
+        self.phenotypes = [str(name) for name in arrays["phenotypes"]]
+        self.image_codes = arrays["image_codes"]  # image of each cell
+        self.images = [str(name) for name in arrays["images"]]
+        self.order = arrays["order"]  # cells sorted by grid and bin
+        self.starts = arrays["starts"]  # first position in `order` of each bin
+        self.grids = arrays["grids"]  # x0, y0, size, columns, rows, first bin
+        self.grid_ids = arrays["grid_ids"]  # grid by image and phenotype, or -1
+
+    def count_within(self, phenotype="", radius=0.0, from_phenotype=None):
+        """Return the cell IDs of the query cells and, for each, the number of
+        cells of a phenotype within a radius as a tuple of arrays.
+
+        Keyword arguments:
+        phenotype -- the phenotype of the cells to count (default "")
+        radius -- the maximum distance of counted cells (default "0.0")
+        from_phenotype -- the phenotype of the query cells, all if `None`
+                          (default "None")
+        """
+        cells = self.get_cells(from_phenotype)
+        counts = np.zeros(len(cells), dtype=np.int64)
+        for grid, subset in self.get_grids(cells, phenotype):
+            offsets = get_offsets(int(np.ceil(radius / grid[2])), ring=False)
+            for chunk in get_chunks(len(subset), len(offsets)):
+                queries, points, distances = self.get_pairs(
+                    grid, cells[subset[chunk]], offsets
+                )
+                inside = distances <= radius * radius
+                counts[subset[chunk]] += np.bincount(
+                    queries[inside], minlength=len(subset[chunk])
+                ).astype(np.int64)
+        return (self.cell_ids[cells], counts)
+
+    def get_cells(self, phenotype=None):
+        """Return the positions of the cells of a phenotype, all if `None`."""
+        if phenotype is None:
+            return np.arange(len(self.x))
+        if phenotype not in self.phenotypes:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(self.codes == self.phenotypes.index(phenotype))
+
+    def get_grids(self, cells=None, phenotype=""):
+        """Yield the grid of a phenotype in each image of the query cells and the
+        positions of the query cells of that image in `cells`.
+
+        Keyword arguments:
+        cells -- the positions of the query cells (default "None")
+        phenotype -- the phenotype of the grids (default "")
+        """
+        if phenotype not in self.phenotypes or not len(cells):
+            return
+        grid_ids = self.grid_ids[
+            self.image_codes[cells], self.phenotypes.index(phenotype)
+        ]
+        order = np.argsort(grid_ids, kind="stable")
+        grid_ids = grid_ids[order]
+        bounds = np.append(np.flatnonzero(np.diff(grid_ids, prepend=-2)), len(order))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if grid_ids[start] >= 0:  # phenotype in image
+                yield (self.grids[grid_ids[start]], order[start:stop])
+
+    def get_pairs(self, grid=None, cells=None, offsets=None):
+        """Return the query positions, the cell positions, and their squared
+        distances for all cells in the bins at the offsets from each query cell.
+
+        Keyword arguments:
+        grid -- the parameters of the phenotype grid (default "None")
+        cells -- the positions of the query cells (default "None")
+        offsets -- the (column, row) offsets of the bins to search (default "None")
+        """
+        x0, y0, size, columns, rows, first = grid
+        columns, rows, first = int(columns), int(rows), int(first)
+        column = np.floor((self.x[cells] - x0) / size).astype(np.int64)
+        row = np.floor((self.y[cells] - y0) / size).astype(np.int64)
+        column = column[:, None] + offsets[:, 0]
+        row = row[:, None] + offsets[:, 1]
+        valid = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+        queries = np.nonzero(valid)[0]
+        bins = (row * columns + column)[valid] + first
+        begins = self.starts[bins]
+        counts = self.starts[bins + 1] - begins
+        queries = np.repeat(queries, counts)
+        positions = np.repeat(begins - (np.cumsum(counts) - counts), counts)
+        points = self.order[positions + np.arange(len(positions))]
+        other = points != cells[queries]  # skip query cell
+        queries, points = queries[other], points[other]
+        distances = (self.x[points] - self.x[cells[queries]]) ** 2 + (
+            self.y[points] - self.y[cells[queries]]
+        ) ** 2
+        return (queries, points, distances)
+
+    def nearest(self, phenotype="", from_phenotype=None):
+        """Return the cell IDs of the query cells and, for each, the distance to
+        and the cell ID of the nearest cell of a phenotype as a tuple of arrays.
+        Distances and cell IDs are NaN, if there is no cell of the phenotype
+        in the image of the query cell.
+
+        Keyword arguments:
+        phenotype -- the phenotype of the cells to find (default "")
+        from_phenotype -- the phenotype of the query cells, all if `None`
+                          (default "None")
+        """
+        cells = self.get_cells(from_phenotype)
+        distances = np.full(len(cells), np.inf)
+        nearest = np.full(len(cells), -1, dtype=np.int64)
+        for grid, active in self.get_grids(cells, phenotype):
+            ring = 0
+            while active.size and ring <= max(grid[3], grid[4]):
+                offsets = get_offsets(ring, ring=True)
+                for chunk in get_chunks(active.size, len(offsets)):
+                    subset = active[chunk]
+                    queries, points, squares = self.get_pairs(
+                        grid, cells[subset], offsets
+                    )
+                    if not len(queries):
+                        continue
+                    first = np.flatnonzero(np.diff(queries, prepend=-1))  # sorted
+                    closest = np.minimum.reduceat(squares, first)
+                    lengths = np.diff(np.append(first, len(queries)))
+                    hits = np.flatnonzero(squares == np.repeat(closest, lengths))
+                    hits = hits[np.diff(queries[hits], prepend=-1) != 0]
+                    queries = subset[queries[hits]]
+                    points, squares = points[hits], squares[hits]
+                    closer = squares < distances[queries]
+                    distances[queries[closer]] = squares[closer]
+                    nearest[queries[closer]] = points[closer]
+                # cells in further rings are at least `ring` bins away
+                active = active[distances[active] > (ring * grid[2]) ** 2]
+                ring += 1
+        found = nearest >= 0
+        neighbors = np.full(len(cells), np.nan)
+        neighbors[found] = self.cell_ids[nearest[found]]
+        distances[~found] = np.nan
+        return (self.cell_ids[cells], np.sqrt(distances), neighbors)
+
+    def save(self, path=""):
+        """Save the index to a numpy archive file."""
+        with open(path, "wb") as out_file:
+            np.savez(out_file, **self.arrays)
+
+
+#  functions
+
+
+def build_index(
+    x=None, y=None, phenotypes=None, cell_ids=None, images=None, points_per_bin=1
+):
+    """Return the spatial index of cells, cells without positions are skipped.
+
+    Keyword arguments:
+    x -- the array of horizontal positions (default "None")
+    y -- the array of vertical positions (default "None")
+    phenotypes -- the array of phenotype names (default "None")
+    cell_ids -- the array of cell IDs (default "None")
+    images -- the array of image names, one image if `None` (default "None")
+    points_per_bin -- the average number of cells per bin (default "1")
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if images is None:
+        images = np.full(len(x), "")
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = x[valid], y[valid]
+    cell_ids = np.asarray(cell_ids, dtype=np.float64)[valid]
+    names, codes = np.unique(
+        np.asarray(phenotypes, dtype=str)[valid], return_inverse=True
+    )
+    image_names, image_codes = np.unique(
+        np.asarray(images, dtype=str)[valid], return_inverse=True
+    )
+    grid_ids = np.full((len(image_names), len(names)), -1, dtype=np.int64)
+    order, starts, grids = [], [], []
+    first = position = 0
+    by_image = np.argsort(image_codes, kind="stable")
+    bounds = np.searchsorted(image_codes[by_image], np.arange(len(image_names) + 1))
+    for image in range(len(image_names)):
+        cells = by_image[bounds[image] : bounds[image + 1]]
+        x0, y0 = x[cells].min(), y[cells].min()
+        width, height = x[cells].max() - x0, y[cells].max() - y0
+        area = max(width, 1.0) * max(height, 1.0)
+        for code in np.unique(codes[cells]):
+            members = cells[codes[cells] == code]
+            size = np.sqrt(area * points_per_bin / len(members))
+            columns, rows = int(width // size) + 1, int(height // size) + 1
+            bins = np.floor((y[members] - y0) / size).astype(np.int64) * columns
+            bins += np.floor((x[members] - x0) / size).astype(np.int64)
+            sort = np.argsort(bins, kind="stable")
+            order.append(members[sort])
+            starts.append(
+                np.searchsorted(bins[sort], np.arange(columns * rows + 1)) + position
+            )
+            grid_ids[image, code] = len(grids)
+            grids.append((x0, y0, size, columns, rows, first))
+            first += columns * rows + 1
+            position += len(members)
+    return SpatialIndex(
+        {
+            "x": x,
+            "y": y,
+            "cell_ids": cell_ids,
+            "codes": codes.astype(np.int32),
+            "phenotypes": names,
+            "image_codes": image_codes.astype(np.int32),
+            "images": image_names,
+            "order": np.concatenate(order) if order else np.zeros(0, dtype=np.int64),
+            "starts": (
+                np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+            ),
+            "grids": np.array(grids, dtype=np.float64).reshape(-1, 6),
+            "grid_ids": grid_ids,
+        }
+    )
+
+
+def get_chunks(queries=0, offsets=1):
+    """Yield slices of query cells, limiting the number of bins searched at once.
+
+    Keyword arguments:
+    queries -- the number of query cells (default "0")
+    offsets -- the number of bins searched per query cell (default "1")
+    """
+    step = max(1, CHUNK_BINS // max(1, offsets))
+    for start in range(0, queries, step):
+        yield slice(start, start + step)
+
+
+def get_index_path(path=""):
+    """Return the path to the index file of a split file.
+
+    Keyword arguments:
+    path -- the path to the split file (default "")
+    """
+    return os.path.splitext(path)[0] + INDEX_EXTENSION
+
+
+def get_offsets(reach=0, ring=False):
+    """Return the (column, row) offsets of the bins within a reach as an array.
+
+    Keyword arguments:
+    reach -- the maximum offset in bins (default "0")
+    ring -- return only the offsets at the maximum offset (default "False")
+    """
+    steps = np.arange(-reach, reach + 1)
+    columns, rows = np.meshgrid(steps, steps)
+    offsets = np.column_stack((columns.ravel(), rows.ravel()))
+    if ring:
+        offsets = offsets[np.abs(offsets).max(axis=1) == reach]
+    return offsets
+
+
+def load_index(path=""):
+    """Return the spatial index saved in a numpy archive file.
+
+    Keyword arguments:
+    path -- the path to the index file (default "")
+    """
+    with np.load(path) as data:
+        return SpatialIndex({name: data[name] for name in data.files})
+
+
+def read_cells(path="", phenotype_label="Phenotype", delimiter="\t"):
+    """Return the positions, phenotypes, cell IDs, and image (sample) names
+    from an inForm file as a tuple of arrays. Non-numeric values are returned
+    as NaN.
+
+    Keyword arguments:
+    path -- the path to the inForm file (default "")
+    phenotype_label -- the label of the phenotype column (default "Phenotype")
+    delimiter -- the column delimiter (default "\\t")
+    """
+    with open(path, "r") as in_file:
+        header = in_file.readline().rstrip("\r\n").split(delimiter)
+        indices = [
+            header.index(label)
+            for label in (X_LABEL, Y_LABEL, phenotype_label, ID_LABEL, IMAGE_LABEL)
+        ]
+        columns = ([], [], [], [], [])
+        for line in in_file:
+            values = line.rstrip("\r\n").split(delimiter)
+            for column, index in zip(columns, indices):
+                column.append(values[index] if index < len(values) else "")
+    x, y, phenotypes, cell_ids, images = columns
+    return (
+        np.array([to_float(value) for value in x]),
+        np.array([to_float(value) for value in y]),
+        np.array(phenotypes, dtype=str),
+        np.array([to_float(value) for value in cell_ids]),
+        np.array(images, dtype=str),
+    )
+
+
+def to_float(value=""):
+    """Convert a text value to float, non-numeric values are replaced with NaN.
+
+    Keyword arguments:
+    value -- the text value to convert (default "")
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+#  constants & variables
+
+CHUNK_BINS = 1048576  # query cells times bins searched at once
+EXPORT_FOLDER = r".\export"
+FILE_TARGET = "*.txt"
+ID_LABEL = "Cell ID"
+IMAGE_LABEL = "Sample Name"  # one image per sample (MSI)
+INDEX_EXTENSION = ".spatial.npz"
+PHENOTYPE_LABEL = "Phenotype"
+VERSION = "spatial_index 1.0 (2024-10-24)"
+X_LABEL = "Cell X Position"
+Y_LABEL = "Cell Y Position"
+
+#  main program
+
+if __name__ == "__main__":
+    print(VERSION)
+    print(os.linesep)
+    print("INDEXING files in folder:")
+    print("-----------------------")
+    print('FILE: "' + FILE_TARGET + '"')
+    FILE_COUNT = 0
+
+    for file in get_files(EXPORT_FOLDER, include=[FILE_TARGET]):
+        print('\tFILE: "' + file + '"', flush=True)
+        index_path = get_index_path(file)
+        if os.path.exists(index_path) and os.path.getmtime(
+            index_path
+        ) >= os.path.getmtime(file):
+            print("\t\tCURRENT")
+            continue
+        try:
+            cells = read_cells(file, phenotype_label=PHENOTYPE_LABEL)
+        except ValueError:  # not an inForm file
+            print("\t\tCOLUMNS: MISSING")
+            continue
+        index = build_index(*cells)
+        index.save(index_path)
+        print(
+            "\t\tCELLS: " + str(len(index.x)),
+            "IMAGES: " + str(len(index.images)),
+            "PHENOTYPES: " + str(len(index.phenotypes)),
+        )
+        FILE_COUNT += 1
+
+    print("FILES: " + str(FILE_COUNT))
+    print(os.linesep)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2024 The Regents of the University of Colorado
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Author:     Christian Rickert <christian.rickert@cuanschutz.edu>
+Group:      Human Immune Monitoring Shared Resource (HIMSR)
+            University of Colorado, Anschutz Medical Campus
+
+Title:      summary_table
+Summary:    Summarize cell counts and column means per sample and phenotype
+            while splitting merge files
+
+DOI:        https://doi.org/10.5281/zenodo.4741394
+URL:        https://github.com/christianrickert/CU-HIMSR/
+
+Description:
+
+This module is used by the splitters to summarize the data while streaming
+through the merge files, so that no second pass over the split files is
+required: Lines are collected in chunks per group (sample, MSI, or image)
+and each chunk is accumulated column by column into counts, sums, and sums
+of squares per group and phenotype. Non-numeric values are not counted.
+Groups of cached merge files are accumulated from the cached columns
+instead, without parsing their lines, see the "cell_table_cache" module.
+The accumulated data can be stored (e.g. in the run manifest) and merged,
+so that unchanged merge files do not need to be read again in later runs.
+The summary table lists the number of cells and the mean and standard
+deviation of each summarized column per group and phenotype, and for all
+phenotypes of a group combined ("All").
+"""
+
+#  imports
+
+import io
+import math
+import operator
+import re
+
+from cell_table_cache import split_line
+
+#  classes
+
+
+class SummaryTable:
+    """Accumulates cell counts and column statistics per group and phenotype.
+
+    Keyword arguments:
+    pattern -- the regular expression matching the labels to summarize (default "")
+    phenotype_label -- the label of the phenotype column, if any (default "None")
+    delimiter -- the column delimiter (default "\\t")
+    chunk_lines -- the number of lines accumulated at once (default "10000")
+    """
+
+    def __init__(
+        self, pattern="", phenotype_label=None, delimiter="\t", chunk_lines=10000
+    ):
+        self.pattern = re.compile(pattern)
+        self.phenotype_label = phenotype_label
+        self.delimiter = delimiter
+        self.chunk_lines = chunk_lines
+        self.labels = []  # summarized labels of all headers
+        self.groups = {}  # (group, phenotype): [count, {label: [values, sum, squares]}]
+        self.columns = []  # summarized indices of the current header
+        self.column_labels = []  # summarized labels of the current header
+        self.phenotype_index = None
+        self.width = 0
+        self.group = None
+        self.lines = []
+
+    def add(self, group="", line=""):
+        """Add a data line of a group, accumulate chunks of lines per group."""
+        if group != self.group or len(self.lines) >= self.chunk_lines:
+            self.flush()
+            self.group = group
+        self.lines.append(line)
+
+    def add_rows(self, group="", cache=None, start=0, stop=0):
+        """Add the data lines of a group from the columns of a cell table cache,
+        the lines are only parsed if the phenotypes are not cached as text."""
+        if (
+            self.phenotype_index is not None
+            and cache.get_column(self.phenotype_index)[1] is None
+        ):  # parse lines
+            lines = cache.get_rows(start, stop).tobytes().decode(cache.encoding)
+            for line in io.StringIO(lines):
+                self.add(group, line)
+            return
+        self.flush()
+        for first in range(start, stop, self.chunk_lines):
+            last = min(first + self.chunk_lines, stop)
+            rows = {"All": None}  # rows by phenotype
+            if self.phenotype_index is not None:
+                rows = {}
+                phenotypes = cache.get_texts(self.phenotype_index, first, last)
+                for row, phenotype in enumerate(phenotypes):
+                    rows.setdefault(phenotype, []).append(row)
+            entries = {phenotype: {} for phenotype in rows}
+            for label, index in zip(self.column_labels, self.columns):
+                column = cache.get_numbers(index, first, last)
+                for phenotype, indices in rows.items():
+                    numbers = to_numbers(
+                        column if indices is None else [column[row] for row in indices]
+                    )
+                    entries[phenotype][label] = [
+                        len(numbers),
+                        math.fsum(numbers),
+                        math.fsum(map(operator.mul, numbers, numbers)),
+                    ]
+            for phenotype, indices in rows.items():
+                count = last - first if indices is None else len(indices)
+                add_entry(self.groups, (group, phenotype), count, entries[phenotype])
+
+    def flush(self):
+        """Accumulate the collected lines of the current group."""
+        if not self.lines:
+            return
+        rows = {}  # rows by phenotype
+        for line in self.lines:
+            values = split_line(line.rstrip("\r\n"), self.delimiter)
+            if len(values) < self.width:  # short lines
+                values += [""] * (self.width - len(values))
+            phenotype = (
+                "All" if self.phenotype_index is None else values[self.phenotype_index]
+            )
+            rows.setdefault(phenotype, []).append(values)
+        for phenotype, values in rows.items():
+            columns = {}
+            if self.columns:  # extra item for a tuple, ignored by `zip()`
+                getter = operator.itemgetter(*self.columns, 0)
+                for label, column in zip(self.column_labels, zip(*map(getter, values))):
+                    numbers = to_numbers(column)
+                    columns[label] = [
+                        len(numbers),
+                        math.fsum(numbers),
+                        math.fsum(map(operator.mul, numbers, numbers)),
+                    ]
+            add_entry(self.groups, (self.group, phenotype), len(values), columns)
+        self.lines = []
+
+    def get_data(self):
+        """Return the accumulated data as a JSON-serializable dictionary."""
+        self.flush()
+        return {
+            "labels": list(self.labels),
+            "groups": [
+                [group, phenotype, count, columns]
+                for (group, phenotype), (count, columns) in self.groups.items()
+            ],
+        }
+
+    def merge(self, data=None):
+        """Add the accumulated data from another summary, see `get_data()`."""
+        self.flush()
+        for label in data["labels"]:
+            if label not in self.labels:
+                self.labels.append(label)
+        for group, phenotype, count, columns in data["groups"]:
+            add_entry(self.groups, (group, phenotype), count, columns)
+
+    def set_header(self, header=""):
+        """Select the summarized columns and the phenotype column from a header line."""
+        self.flush()
+        labels = split_line(header.rstrip("\r\n"), self.delimiter)
+        self.columns = [
+            index for index, label in enumerate(labels) if self.pattern.search(label)
+        ]
+        self.column_labels = [labels[index] for index in self.columns]
+        for label in self.column_labels:
+            if label not in self.labels:
+                self.labels.append(label)
+        self.phenotype_index = None
+        if self.phenotype_label in labels:
+            self.phenotype_index = labels.index(self.phenotype_label)
+        self.width = len(labels)
+
+    def write(self, path="", group_label="Sample Name"):
+        """Write the summary table with one line per group and phenotype.
+
+        Keyword arguments:
+        path -- the path to the summary file (default "")
+        group_label -- the label of the group column (default "Sample Name")
+        """
+        self.flush()
+        entries = {}
+        for (group, phenotype), (count, columns) in self.groups.items():
+            add_entry(entries, (group, phenotype), count, columns)
+            if phenotype != "All":  # combine phenotypes
+                add_entry(entries, (group, "All"), count, columns)
+        labels = [group_label, "Phenotype", "Cell Count"]
+        for label in self.labels:
+            labels.extend((label + " Mean", label + " SD"))
+        with open(path, "w", encoding="utf-8") as out_file:
+            out_file.write(self.delimiter.join(labels) + "\n")
+            for group, phenotype in sorted(
+                entries, key=lambda key: (key[0], key[1] == "All", key[1])
+            ):
+                count, columns = entries[(group, phenotype)]
+                values = [group, phenotype, str(count)]
+                for label in self.labels:
+                    values.extend(get_statistics(*columns.get(label, (0, 0.0, 0.0))))
+                out_file.write(self.delimiter.join(values) + "\n")
+
+
+#  functions
+
+
+def add_entry(entries=None, key=None, count=0, columns=None):
+    """Add a cell count and column statistics to an entry of a dictionary.
+
+    Keyword arguments:
+    entries -- the dictionary of [count, {label: [values, sum, squares]}] entries
+               (default "None")
+    key -- the key of the entry (default "None")
+    count -- the number of cells (default "0")
+    columns -- the dictionary with the statistics per label (default "None")
+    """
+    entry = entries.setdefault(key, [0, {}])
+    entry[0] += count
+    for label, values in columns.items():
+        stats = entry[1].setdefault(label, [0, 0.0, 0.0])
+        for index, value in enumerate(values):
+            stats[index] += value
+
+
+def get_statistics(count=0, total=0.0, squares=0.0):
+    """Return the mean and standard deviation from accumulated values as text,
+    empty if there are not enough values.
+
+    Keyword arguments:
+    count -- the number of values (default "0")
+    total -- the sum of values (default "0.0")
+    squares -- the sum of squared values (default "0.0")
+    """
+    if not count:
+        return ("", "")
+    mean = total / count
+    if count < 2:
+        return (format(mean, ".6g"), "")
+    variance = max(0.0, (squares - total * mean) / (count - 1))
+    return (format(mean, ".6g"), format(math.sqrt(variance), ".6g"))
+
+
+def to_numbers(values=()):
+    """Return the numeric values of a column as floats, skipping other values.
+
+    Keyword arguments:
+    values -- the text values of the column (default "")
+    """
+    try:
+        numbers = list(map(float, values))
+    except ValueError:  # slow path
+        numbers = []
+        for value in values:
+            try:
+                numbers.append(float(value))
+            except ValueError:
+                continue
+    if math.isnan(sum(numbers)):  # skip NaN
+        numbers = [number for number in numbers if not math.isnan(number)]
+    return numbers
@@ -40,40 +40,25 @@ In the "Grid/Collection stitching" plugin, please choose the "Positions from
 file" (Type) and "Defined by TileConfiguration" (Order) in the first dialog.
 In the second dialog, you should only "Compute the overlap" if applicable,
 otherwise the plugin will throw an exception.
+Run metrics are recorded with the "run_metrics" module, use the "--quiet"
+option to skip progress messages for large data sets.
+Resolutions and positions are kept in a manifest next to the output file,
+so that only new or changed TIFFs are read in later runs, see "run_manifest".
 
 See: https://imagej.net/plugins/image-stitching
 """
 
 
 # imports
-import fnmatch
 import os
 import sys
 import tifffile as tifff
+from file_discovery import get_files
+from run_manifest import RunManifest, get_manifest_file
+from run_metrics import RunMetrics
 
 
 # functions
-def get_files(path="", pat=None, anti=None, recurse=True):
-    """Iterate through all files in a folder structure and
-    return a list of matching files.
-
-    Keyword arguments:
-    path -- the path to a folder containing files (default "")
-    pat -- string pattern that needs to be part of the file name (default "None")
-    anti -- string pattern that may not be part of the file name (default "None")
-    recurse -- boolen that allows the function to work recursively (default "False")
-    """
-    FILES = []
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            file = os.path.join(root, file)
-            if fnmatch.fnmatch(file, pat) and not fnmatch.fnmatch(file, anti):
-                FILES.append(file)
-        if not recurse:
-            break  # from `os.walk()`
-    return FILES
-
-
 def get_grid_layout(coordinates=None):
     """Sort a list of coordinates and return a tuple of set-like coordinate lists.
     The two lists will denote the X and Y coordinates for each grid column and row.
@@ -166,9 +151,11 @@ def get_tiff_unit(tiff=None):
 
 
 # variables
+FAST_HASH = False  # also fingerprint TIFFs by sampled content
 FILE_TARGET = "*.tif"  # file search pattern
 FOLDER = os.path.abspath(os.getcwd())  # working directory
 IN_CM = 2.54  # inch to centimeter
+INCREMENTAL = True  # read only new or changed TIFFs
 INVERT_Y_AXIS = False  # MIBIscope
 LINESEP = "\n"  # newline character
 OFFSETS = [0, 0]  # pixel offsets for tile locations
@@ -177,14 +164,20 @@ VERSION = "write_tileconfig 0.9 (2023-12-21)"
 
 
 #  main program
+METRICS = RunMetrics(VERSION)
 print(os.linesep, flush=True)
 print(VERSION, flush=True)
 print(LINESEP + f"FOLDER: {FOLDER}", flush=True)
 
 # prepare list of files
+METRICS.start_phase("files")
 FILES = []
-for file in get_files(path=FOLDER, pat=FILE_TARGET, anti="", recurse=False):
+for file in get_files(path=FOLDER, include=[FILE_TARGET]):
     FILES.append(file)
+MANIFEST = None
+if INCREMENTAL:
+    MANIFEST = RunManifest(os.path.join(FOLDER, get_manifest_file(VERSION)), FAST_HASH)
+    MANIFEST.prune(FILES)
 
 # write tile configuration file
 with open(
@@ -207,29 +200,38 @@ with open(
         + LINESEP
     )
     # determine image locations
+    METRICS.start_phase("positions")
     locations = []
     file_out.write("# Define the image coordinates (in pixels)" + LINESEP)
     for file in FILES:
         name = os.path.basename(file)
-        print(LINESEP + f"\tFILE: {name}", flush=True)
-        with tifff.TiffFile(file) as tif:
-            UNIT = get_tiff_unit(tif)  # [px, inch, cm]
-            resolutions = get_tiff_res(tif, UNIT)  # [px, cm]
-            x, y, u = get_tiff_pos(tif, UNIT)  # [px, cm]
-            location = (
-                round(resolutions[0] * float(x)),
-                round(resolutions[1] * float(y)),
-            )  # [px]
-            locations.append(location)
-            print(
-                f"\t\tRES = {resolutions[0]},{resolutions[1]} (1/{u})"
-                + LINESEP
-                + f"\t\tPOS = [{x},{y}] ({u})"
-                + LINESEP
-                + f"\t\tLOC = [{locations[-1][0]},{locations[-1][1]}] (px)",
-                flush=True,
-            )
+        METRICS.log(LINESEP + f"\tFILE: {name}")
+        cached = MANIFEST.get_data(file) if MANIFEST else None
+        if cached is None:  # new or changed TIFF
+            METRICS.count(rows=1, files=1)
+            with tifff.TiffFile(file) as tif:
+                UNIT = get_tiff_unit(tif)  # [px, inch, cm]
+                resolutions = get_tiff_res(tif, UNIT)  # [px, cm]
+                x, y, u = get_tiff_pos(tif, UNIT)  # [px, cm]
+            if MANIFEST:
+                MANIFEST.record(file, data=[*resolutions[0:2], x, y, u])
+        else:
+            resolutions = cached[0:2]
+            x, y, u = cached[2:5]
+        location = (
+            round(resolutions[0] * float(x)),
+            round(resolutions[1] * float(y)),
+        )  # [px]
+        locations.append(location)
+        METRICS.log(
+            f"\t\tRES = {resolutions[0]},{resolutions[1]} (1/{u})"
+            + LINESEP
+            + f"\t\tPOS = [{x},{y}] ({u})"
+            + LINESEP
+            + f"\t\tLOC = [{locations[-1][0]},{locations[-1][1]}] (px)"
+        )
     # determine row and column coordinates
+    METRICS.start_phase("layout")
     columns, rows = get_grid_layout(locations)
     # adjust coordinate system upon request
     if INVERT_Y_AXIS:
@@ -252,3 +254,7 @@ with open(
             + ")"
             + LINESEP
         )
+METRICS.count_written(os.path.abspath(FOLDER + os.sep + OUTPUT))
+if MANIFEST:
+    MANIFEST.save()
+METRICS.finish()